@@ -1,10 +1,115 @@
 import flet as ft
+import argparse
+import asyncio
+import csv
+import functools
+import gzip
+import hashlib
+import http.server
+import inspect
+import io
+import json
+import multiprocessing
 import os
+import queue
+import random
+import re
+import select
+import shutil
+import signal
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import urllib.request
+import weakref
+import atexit
 import psycopg2
-from datetime import datetime
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.sql
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
 
 # --- ASETUKSET ---
+# Tietokantamoottori: "postgres" (DATABASE_URL) tai "sqlite" (SQLITE_PATH)
+DB_BACKEND = os.getenv("DB_BACKEND", "postgres")
+SQLITE_PATH = os.getenv("SQLITE_PATH", "diidelain.db")
+SQLITE_BUSY_TIMEOUT = float(os.getenv("SQLITE_BUSY_TIMEOUT", "5"))
+
 DATABASE_URL = os.getenv("DATABASE_URL")
+# Paikalliset testikannat eivät yleensä tue SSL:ää
+DB_SSLMODE = os.getenv("DB_SSLMODE", "require")
+# Yhteyspooli (koot kpl, ajat sekunteina)
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", "300"))
+DB_POOL_MAX_LIFETIME = float(os.getenv("DB_POOL_MAX_LIFETIME", "3600"))
+DB_POOL_CHECK_AFTER = float(os.getenv("DB_POOL_CHECK_AFTER", "5"))
+# Aikarajat sekunteina: yhteyden avaus ja yksittäinen kysely (0 = ei rajaa)
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", "5"))
+DB_STATEMENT_TIMEOUT = float(os.getenv("DB_STATEMENT_TIMEOUT", "10"))
+# Lukujen uusintayritykset ja niiden perusviive (s). Katkaisin aukeaa näin monen
+# peräkkäisen yhteysvirheen jälkeen (0 = pois) ja päästää uuden yrityksen DB_BREAKER_RESET sekunnin päästä.
+DB_READ_RETRIES = int(os.getenv("DB_READ_RETRIES", "2"))
+DB_RETRY_BASE = float(os.getenv("DB_RETRY_BASE", "0.1"))
+DB_BREAKER_THRESHOLD = int(os.getenv("DB_BREAKER_THRESHOLD", "5"))
+DB_BREAKER_RESET = float(os.getenv("DB_BREAKER_RESET", "15"))
+# Työprosessit samassa portissa (1 = yksi prosessi). DB_POOL_BUDGET on koko koneen
+# yhteysraja, joka jaetaan prosesseille (0 = jokaisella oma DB_POOL_MAX); jos se ei riitä
+# kaikille prosesseille, niitä käynnistetään vähemmän
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", "1"))
+DB_POOL_BUDGET = int(os.getenv("DB_POOL_BUDGET", "0"))
+# Tehtävälista: "column" rakentaa kaikki kortit, "virtual" vain näkyvät (ListView)
+TASK_LIST_MODE = os.getenv("TASK_LIST_MODE", "column")
+TASK_ITEM_EXTENT = float(os.getenv("TASK_ITEM_EXTENT")) if os.getenv("TASK_ITEM_EXTENT") else None
+TASK_ITEM_ESTIMATE = float(os.getenv("TASK_ITEM_ESTIMATE", "80"))
+TASK_PAGE_SIZE = int(os.getenv("TASK_PAGE_SIZE", "50"))
+TASK_LIST_BUFFER = int(os.getenv("TASK_LIST_BUFFER", "10"))
+# Selaimen client_storageen tallennettava näkymä, jonka uusi istunto piirtää heti
+# (rivejä enintään, 0 = pois). Versio kasvaa, kun tallenteen muoto muuttuu.
+CLIENT_SNAPSHOT_ROWS = int(os.getenv("CLIENT_SNAPSHOT_ROWS", "200"))
+CLIENT_SNAPSHOT_KEY = "diidelain.snapshot"
+CLIENT_SNAPSHOT_VERSION = 1
+CLIENT_SNAPSHOT_TIMEOUT = 1.0
+CLIENT_SNAPSHOT_DELAY = 1.0
+# Prometheus-mittarit omassa portissaan (0 = pois), hitaiden operaatioiden raja ms (0 = pois).
+# Oletuksena vain paikallisesti; ulkoinen keräin vaatii METRICS_HOST=0.0.0.0 tai oman osoitteen.
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+SLOW_OP_MS = float(os.getenv("SLOW_OP_MS", "0"))
+
+# Muutosilmoitukset istuntojen välillä (Postgres LISTEN/NOTIFY)
+NOTIFY_CHANNEL = os.getenv("NOTIFY_CHANNEL", "diidelain_changes")
+NOTIFY_CHUNK = 500
+
+# Tekstihaun viive kirjoitettaessa (s) ja hakusanojen enimmäismäärä
+SEARCH_DEBOUNCE = float(os.getenv("SEARCH_DEBOUNCE", "0.3"))
+SEARCH_MAX_TERMS = 8
+
+# Kirjoitusjono: odotus ennen erän tallennusta (s) ja erän maksimikoko
+WRITE_FLUSH_DELAY = float(os.getenv("WRITE_FLUSH_DELAY", "0.2"))
+WRITE_MAX_BATCH = int(os.getenv("WRITE_MAX_BATCH", "500"))
+
+# Tehdyt tehtävät siirretään arkistoon näin monen päivän jälkeen (0 = ei arkistointia);
+# siirtäjä herää ARCHIVE_INTERVAL sekunnin välein ja siirtää ARCHIVE_BATCH riviä kerrallaan
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", "3600"))
+ARCHIVE_BATCH = int(os.getenv("ARCHIVE_BATCH", "1000"))
+
+# Omat fontit ja ikonit: tarjotaan osoitteessa /static sisältötiivisteellisin nimin,
+# joten ensimmäinen piirto ei riipu ulkopuolisista palvelimista
+ASSETS_DIR = os.getenv("ASSETS_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets"))
+ASSETS_URL = "/static"
+RETRO_FONT = "fonts/PressStart2P-Regular.ttf"
+# Alkuperäiset lähteet, joista `app.py assets --fetch` hakee puuttuvat tiedostot kerran.
+# Ajon aikana niitä ei käytetä: puuttuva fontti korvataan teeman oletusfontilla.
+FONT_SOURCES = {
+    RETRO_FONT: "https://github.com/google/fonts/raw/main/ofl/pressstart2p/PressStart2P-Regular.ttf"
+}
 # Teeman värit
 COLOR_BG = "#FAECB6"
 COLOR_PRIMARY = "#2BBAA5"
@@ -50,6 +155,13 @@ AVAILABLE_COLORS = {
     "Musta": "#333333"
 }
 
+# Päivämääränäkymät: avoimet tehtävät deadlinen mukaan, välilehtirivillä heti "Kaikki"-välilehden jälkeen
+DUE_VIEWS = {
+    "Myöhässä": ft.Icons.WARNING_AMBER,
+    "Tänään": ft.Icons.TODAY,
+    "Tällä viikolla": ft.Icons.DATE_RANGE
+}
+
 # --- APUFUNKTIOT ---
 def date_db_to_fi(db_date):
     try:
@@ -76,274 +188,2730 @@ def date_fi_to_db(fi_date):
         pass
     return fi_date 
 
+def date_fi_to_date(fi_date):
+    try:
+        return datetime.strptime(date_fi_to_db(fi_date), "%Y-%m-%d").date()
+    except:
+        return None
+
+def due_range(view, today=None):
+    # Päivämääränäkymän deadline-väli [alku, loppu); alku None = ei alarajaa
+    today = today or date.today()
+    if view == "Myöhässä":
+        return None, today
+    if view == "Tänään":
+        return today, today + timedelta(days=1)
+    # Tällä viikolla: tästä päivästä sunnuntaihin
+    return today, today + timedelta(days=7 - today.weekday())
+
+def search_terms(query):
+    # Hakusanat ilman välimerkkejä; jokaista käytetään sanan alkuna
+    return re.findall(r"\w+", (query or "").lower())[:SEARCH_MAX_TERMS]
+
+# --- TUONTI JA VIENTI ---
+COPY_FORMATS = ("csv", "ndjson")
+# NDJSON viedään COPY:n csv-muodossa lainausmerkillä, jota JSON ei koskaan sisällä,
+# jolloin rivit tulevat sellaisenaan ilman tekstimuodon kenoviivapakotuksia
+NDJSON_COPY_OPTIONS = "(FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02')"
+
+def parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    return str(value or "").strip().lower() in ("1", "t", "true", "y", "yes", "x", "kyllä")
+
+def read_records(src, fmt):
+    # Lukee tiedostoa rivi kerrallaan ja palauttaa sanakirjoja
+    if fmt == "ndjson":
+        for line in src:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+    else:
+        yield from csv.DictReader(src)
+
+class CopyStream:
+    # Tiedostomainen lukija COPY FROM STDIN:lle: rivit muunnetaan CSV:ksi vasta
+    # kun psycopg2 pyytää lisää dataa, joten muistia kuluu vakiomäärä.
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer, lineterminator="\n")
+        self.pending = ""
+        self.count = 0
+
+    def _fill(self, size):
+        while size < 0 or len(self.pending) < size:
+            row = next(self.rows, None)
+            if row is None:
+                break
+            self.writer.writerow(row)
+            self.count += 1
+            self.pending += self.buffer.getvalue()
+            self.buffer.seek(0)
+            self.buffer.truncate()
+
+    def read(self, size=-1):
+        self._fill(size)
+        if size < 0:
+            data, self.pending = self.pending, ""
+        else:
+            data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+    def readline(self, size=-1):
+        self._fill(1)
+        end = self.pending.find("\n") + 1 or len(self.pending)
+        data, self.pending = self.pending[:end], self.pending[end:]
+        return data
+
+def task_import_row(rec):
+    deadline = (rec.get("deadline") or "").strip()
+    return (
+        rec.get("content"),
+        rec.get("category"),
+        date_fi_to_db(deadline) if deadline else None,
+        parse_bool(rec.get("completed")),
+        rec.get("description") or None,
+    )
+
+def category_import_row(rec):
+    return (rec.get("name"), rec.get("color") or COLOR_PRIMARY, rec.get("icon_name") or "Muu", rec.get("master") or None)
+
+# --- MUUTOSILMOITUKSET ---
+def change_payloads(tasks=(), categories=False, reload=False):
+    # NOTIFY-viestin koko on rajattu, joten id:t jaetaan paloihin
+    payloads = []
+    tasks = list(tasks)
+    for i in range(0, len(tasks), NOTIFY_CHUNK):
+        payloads.append(json.dumps({"tasks": tasks[i:i + NOTIFY_CHUNK]}))
+    if categories:
+        payloads.append(json.dumps({"categories": True}))
+    if reload:
+        payloads.append(json.dumps({"reload": True}))
+    return payloads
+
+# --- SKEEMAMUUTOKSET ---
+# Jokainen vaihe on idempotentti, jotta vanhat tietokannat ilman schema_version-taulua
+# voidaan ajaa alusta asti turvallisesti.
+MIGRATION_LOCK_ID = 720130
+
+def _migrate_base_tables(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS master_categories (
+        id SERIAL PRIMARY KEY,
+        name TEXT UNIQUE,
+        color TEXT,
+        icon_name TEXT
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS categories (
+        id SERIAL PRIMARY KEY,
+        name TEXT UNIQUE,
+        color TEXT,
+        icon_name TEXT,
+        master_id INTEGER REFERENCES master_categories(id)
+    )
+    """)
+
+    cur.execute("SELECT count(*) FROM categories")
+    if cur.fetchone()[0] == 0:
+        defaults = [
+            ("Työ", "#F96635", "Työ"),
+            ("Koulu", "#F9A822", "Koulu"),
+            ("Muu", "#93D3AE", "Muu")
+        ]
+        for name, color, icon in defaults:
+            cur.execute("INSERT INTO categories (name, color, icon_name) VALUES (%s, %s, %s)", (name, color, icon))
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS tasks (
+        id SERIAL PRIMARY KEY,
+        content TEXT,
+        category_id INTEGER REFERENCES categories(id),
+        deadline DATE,
+        completed BOOLEAN DEFAULT FALSE,
+        description TEXT
+    )
+    """)
+
+def _migrate_task_description(cur):
+    cur.execute("ALTER TABLE tasks ADD COLUMN IF NOT EXISTS description TEXT")
+
+def _migrate_category_id(cur):
+    # Vanha tekstimuotoinen tasks.category siirretään category_id-viiteavaimeen
+    cur.execute("ALTER TABLE tasks ADD COLUMN IF NOT EXISTS category_id INTEGER REFERENCES categories(id)")
+    cur.execute("SELECT 1 FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = 'tasks' AND column_name = 'category'")
+    if cur.fetchone():
+        cur.execute("UPDATE tasks t SET category_id = c.id FROM categories c WHERE t.category_id IS NULL AND c.name = t.category")
+        cur.execute("UPDATE tasks SET category_id = (SELECT id FROM categories WHERE name = 'Muu') WHERE category_id IS NULL")
+        cur.execute("ALTER TABLE tasks DROP COLUMN category")
+    cur.execute("DROP INDEX IF EXISTS idx_tasks_category_deadline")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tasks_category_id_deadline ON tasks (category_id, deadline, id)")
+
+def _migrate_deadline_index(cur):
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tasks_deadline ON tasks (deadline, id)")
+
+def _migrate_search(cur):
+    # Otsikon osumat painavat enemmän kuin lisätietojen
+    cur.execute("""
+    ALTER TABLE tasks ADD COLUMN IF NOT EXISTS search tsvector GENERATED ALWAYS AS (
+        setweight(to_tsvector('finnish', coalesce(content, '')), 'A') ||
+        setweight(to_tsvector('finnish', coalesce(description, '')), 'B')
+    ) STORED
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tasks_search ON tasks USING GIN (search)")
+
+def _migrate_row_version(cur):
+    # Jokainen päivitys kasvattaa rivin versiota; käyttöliittymä tunnistaa sillä muuttumattomat rivit
+    cur.execute("ALTER TABLE tasks ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1")
+    cur.execute("""
+    CREATE OR REPLACE FUNCTION tasks_bump_version() RETURNS trigger AS $$
+    BEGIN
+        NEW.version := OLD.version + 1;
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """)
+    cur.execute("DROP TRIGGER IF EXISTS tasks_version ON tasks")
+    cur.execute("CREATE TRIGGER tasks_version BEFORE UPDATE ON tasks FOR EACH ROW EXECUTE FUNCTION tasks_bump_version()")
+
+def _migrate_change_counter(cur):
+    # Yksirivinen laskuri kasvaa jokaisessa tasks-taulun kirjoituksessa. Päivitys kuuluu
+    # kirjoittavaan transaktioon, joten lukija näkee uuden arvon vasta commitin jälkeen.
+    cur.execute("CREATE TABLE IF NOT EXISTS task_changes (id INTEGER PRIMARY KEY CHECK (id = 1), counter BIGINT NOT NULL)")
+    cur.execute("INSERT INTO task_changes (id, counter) VALUES (1, 0) ON CONFLICT DO NOTHING")
+    cur.execute("""
+    CREATE OR REPLACE FUNCTION tasks_bump_changes() RETURNS trigger AS $$
+    BEGIN
+        UPDATE task_changes SET counter = counter + 1 WHERE id = 1;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """)
+    cur.execute("DROP TRIGGER IF EXISTS tasks_changes ON tasks")
+    cur.execute("CREATE TRIGGER tasks_changes AFTER INSERT OR UPDATE OR DELETE ON tasks FOR EACH STATEMENT EXECUTE FUNCTION tasks_bump_changes()")
+
+def _migrate_open_deadline_index(cur):
+    # Vain avoimet tehtävät: myöhässä- ja tulossa-näkymät eivät lue tehtyjä rivejä
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tasks_open_deadline ON tasks (deadline, id) WHERE completed = false")
+
+def _migrate_drop_change_trigger(cur):
+    # Lausetason trigger lukitsi laskuririvin jo ensimmäisen lauseen jälkeen, ja monilauseiset
+    # kirjoitukset jäivät lukkiutumaan toistensa tehtäväriveihin. Laskuria kasvatetaan nyt
+    # _notify:ssa transaktion viimeisenä lukkona.
+    cur.execute("DROP TRIGGER IF EXISTS tasks_changes ON tasks")
+    cur.execute("DROP FUNCTION IF EXISTS tasks_bump_changes()")
+
+def _migrate_archive(cur):
+    # completed_at asetetaan triggerissä, jotta kaikki kirjoituspolut (myös COPY-tuonti) kirjaavat sen
+    cur.execute("ALTER TABLE tasks ADD COLUMN IF NOT EXISTS completed_at TIMESTAMPTZ")
+    cur.execute("""
+    CREATE OR REPLACE FUNCTION tasks_set_completed_at() RETURNS trigger AS $$
+    BEGIN
+        IF NEW.completed THEN
+            NEW.completed_at := coalesce(NEW.completed_at, now());
+        ELSE
+            NEW.completed_at := NULL;
+        END IF;
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """)
+    cur.execute("DROP TRIGGER IF EXISTS tasks_completed_at ON tasks")
+    cur.execute("CREATE TRIGGER tasks_completed_at BEFORE INSERT OR UPDATE OF completed ON tasks FOR EACH ROW EXECUTE FUNCTION tasks_set_completed_at()")
+    cur.execute("UPDATE tasks SET completed_at = now() WHERE completed AND completed_at IS NULL")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tasks_completed_at ON tasks (completed_at) WHERE completed = true")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS tasks_archive (
+        id INTEGER PRIMARY KEY,
+        content TEXT,
+        category_id INTEGER REFERENCES categories(id),
+        deadline DATE,
+        description TEXT,
+        version INTEGER NOT NULL DEFAULT 1,
+        completed_at TIMESTAMPTZ NOT NULL,
+        archived_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tasks_archive_completed_at ON tasks_archive (completed_at, id)")
+
+# SQLite-kanta luodaan aina tyhjästä, joten perustauluissa on heti nykyiset sarakkeet.
+# Hakemistojen "deadline IS NULL" vastaa Postgresin NULL-viimeisenä-järjestystä.
+def _sqlite_base_tables(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS master_categories (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT UNIQUE,
+        color TEXT,
+        icon_name TEXT
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS categories (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT UNIQUE,
+        color TEXT,
+        icon_name TEXT,
+        master_id INTEGER REFERENCES master_categories(id)
+    )
+    """)
+    cur.execute("SELECT count(*) FROM categories")
+    if cur.fetchone()[0] == 0:
+        cur.executemany("INSERT INTO categories (name, color, icon_name) VALUES (%s, %s, %s)", [
+            ("Työ", "#F96635", "Työ"),
+            ("Koulu", "#F9A822", "Koulu"),
+            ("Muu", "#93D3AE", "Muu")
+        ])
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS tasks (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        content TEXT,
+        category_id INTEGER REFERENCES categories(id),
+        deadline DATE,
+        completed BOOLEAN DEFAULT FALSE,
+        description TEXT
+    )
+    """)
+
+def _sqlite_category_index(cur):
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tasks_category_id_deadline ON tasks (category_id, deadline IS NULL, deadline, id)")
+
+def _sqlite_deadline_index(cur):
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tasks_deadline ON tasks (deadline IS NULL, deadline, id)")
+
+def _sqlite_search(cur):
+    # FTS5-hakemisto viittaa tasks-tauluun; triggerit pitävät sen ajan tasalla
+    cur.execute("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS tasks_fts USING fts5(
+        content, description, content='tasks', content_rowid='id', tokenize='unicode61'
+    )
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS tasks_fts_insert AFTER INSERT ON tasks BEGIN
+        INSERT INTO tasks_fts (rowid, content, description) VALUES (new.id, new.content, new.description);
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS tasks_fts_delete AFTER DELETE ON tasks BEGIN
+        INSERT INTO tasks_fts (tasks_fts, rowid, content, description) VALUES ('delete', old.id, old.content, old.description);
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS tasks_fts_update AFTER UPDATE OF content, description ON tasks BEGIN
+        INSERT INTO tasks_fts (tasks_fts, rowid, content, description) VALUES ('delete', old.id, old.content, old.description);
+        INSERT INTO tasks_fts (rowid, content, description) VALUES (new.id, new.content, new.description);
+    END
+    """)
+    cur.execute("INSERT INTO tasks_fts (tasks_fts) VALUES ('rebuild')")
+
+def _sqlite_row_version(cur):
+    # Sarakelista rajaa pois triggerin oman version päivityksen
+    cur.execute("ALTER TABLE tasks ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS tasks_version AFTER UPDATE OF content, category_id, deadline, completed, description ON tasks BEGIN
+        UPDATE tasks SET version = old.version + 1 WHERE id = new.id;
+    END
+    """)
+
+def _sqlite_change_counter(cur):
+    # SQLitessä ei ole lausetason triggereitä, joten laskuri kasvaa riveittäin
+    cur.execute("CREATE TABLE IF NOT EXISTS task_changes (id INTEGER PRIMARY KEY CHECK (id = 1), counter INTEGER NOT NULL)")
+    cur.execute("INSERT OR IGNORE INTO task_changes (id, counter) VALUES (1, 0)")
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS tasks_changes_{event.lower()} AFTER {event} ON tasks BEGIN
+            UPDATE task_changes SET counter = counter + 1 WHERE id = 1;
+        END
+        """)
+
+def _sqlite_open_deadline_index(cur):
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tasks_open_deadline ON tasks (deadline, id) WHERE completed = false")
+
+def _sqlite_archive(cur):
+    # Sisäkkäinen päivitys koskee vain completed_at-saraketta, joten muut triggerit eivät laukea uudelleen
+    cur.execute("ALTER TABLE tasks ADD COLUMN completed_at TIMESTAMP")
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS tasks_completed_at_insert AFTER INSERT ON tasks WHEN new.completed AND new.completed_at IS NULL BEGIN
+        UPDATE tasks SET completed_at = CURRENT_TIMESTAMP WHERE id = new.id;
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS tasks_completed_at_update AFTER UPDATE OF completed ON tasks BEGIN
+        UPDATE tasks SET completed_at = CASE WHEN new.completed THEN coalesce(old.completed_at, CURRENT_TIMESTAMP) END
+        WHERE id = new.id;
+    END
+    """)
+    cur.execute("UPDATE tasks SET completed_at = CURRENT_TIMESTAMP WHERE completed AND completed_at IS NULL")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tasks_completed_at ON tasks (completed_at) WHERE completed = true")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS tasks_archive (
+        id INTEGER PRIMARY KEY,
+        content TEXT,
+        category_id INTEGER REFERENCES categories(id),
+        deadline DATE,
+        description TEXT,
+        version INTEGER NOT NULL DEFAULT 1,
+        completed_at TIMESTAMP NOT NULL,
+        archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tasks_archive_completed_at ON tasks_archive (completed_at, id)")
+
+def _sqlite_deadline_check(cur):
+    # SQLite hyväksyy DATE-sarakkeeseen minkä tahansa tekstin. CHECK-ehtoa ei voi lisätä
+    # olemassa olevaan tauluun, joten virheelliset päivät torjutaan triggereillä.
+    # '+0 days' normalisoi esim. 30.2. maaliskuulle, jolloin se ei vastaa alkuperäistä.
+    for event in ("INSERT", "UPDATE OF deadline"):
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS tasks_deadline_{event.split()[0].lower()} BEFORE {event} ON tasks
+        WHEN new.deadline IS NOT NULL AND date(new.deadline, '+0 days') IS NOT new.deadline BEGIN
+            SELECT RAISE(ABORT, 'virheellinen deadline');
+        END
+        """)
+
+# (versio, kuvaus, Postgres-vaihe, SQLite-vaihe); None = ei muutoksia tälle moottorille
+MIGRATIONS = [
+    (1, "perustaulut", _migrate_base_tables, _sqlite_base_tables),
+    (2, "tehtävien kuvaus", _migrate_task_description, None),
+    (3, "tasks.category_id", _migrate_category_id, _sqlite_category_index),
+    (4, "deadline-hakemisto", _migrate_deadline_index, _sqlite_deadline_index),
+    (5, "tekstihaku", _migrate_search, _sqlite_search),
+    (6, "rivien versiot", _migrate_row_version, _sqlite_row_version),
+    (7, "muutoslaskuri", _migrate_change_counter, _sqlite_change_counter),
+    (8, "avointen deadline-hakemisto", _migrate_open_deadline_index, _sqlite_open_deadline_index),
+    (9, "arkisto", _migrate_archive, _sqlite_archive),
+    (10, "deadlinen tarkistus", None, _sqlite_deadline_check),
+    (11, "muutoslaskuri kirjoitusten lopussa", _migrate_drop_change_trigger, None),
+]
+
+# --- MITTARIT ---
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    def __init__(self, buckets=METRIC_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    # Prosessin yhteiset histogrammit, laskurit ja mittarit Prometheus-tekstimuodossa.
+    # Sarjan avain on (nimi, järjestetyt labelit).
+    def __init__(self, slow_ms=SLOW_OP_MS):
+        self.slow_ms = slow_ms
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+        self._collectors = []
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = Histogram()
+            hist.observe(seconds)
+        if self.slow_ms and seconds * 1000 >= self.slow_ms:
+            details = " ".join(f"{k}={v}" for k, v in sorted(labels.items()))
+            print(f"Hidas operaatio: {name} {details} {seconds * 1000:.1f} ms", file=sys.stderr)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def add(self, name, amount, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = self._gauges.get(key, 0) + amount
+
+    def collector(self, fn):
+        # fn() palauttaa [(nimi, tyyppi, labelit, arvo)] kirjoitushetkellä
+        self._collectors.append(fn)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        # Virheet lasketaan erikseen: *_seconds -> *_errors_total
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.inc(name.replace("_seconds", "_errors_total"), **labels)
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def render(self):
+        samples = {}
+        with self._lock:
+            for (name, labels), hist in self._histograms.items():
+                cumulative = 0
+                lines = samples.setdefault((name, "histogram"), [])
+                for bound, count in zip(hist.buckets, hist.counts):
+                    cumulative += count
+                    lines.append((f"{name}_bucket", labels + (("le", repr(bound)),), cumulative))
+                lines.append((f"{name}_bucket", labels + (("le", "+Inf"),), hist.count))
+                lines.append((f"{name}_sum", labels, hist.sum))
+                lines.append((f"{name}_count", labels, hist.count))
+            for (name, labels), value in self._counters.items():
+                samples.setdefault((name, "counter"), []).append((name, labels, value))
+            for (name, labels), value in self._gauges.items():
+                samples.setdefault((name, "gauge"), []).append((name, labels, value))
+        for fn in self._collectors:
+            for name, kind, labels, value in fn():
+                samples.setdefault((name, kind), []).append((name, tuple(sorted(labels.items())), value))
+
+        out = []
+        for (name, kind), lines in sorted(samples.items()):
+            out.append(f"# TYPE {name} {kind}")
+            for sample, labels, value in lines:
+                if labels:
+                    label_text = ",".join(f'{k}="{metric_label(v)}"' for k, v in labels)
+                    out.append(f"{sample}{{{label_text}}} {value}")
+                else:
+                    out.append(f"{sample} {value}")
+        return "\n".join(out) + "\n"
+
+def metric_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+metrics = Metrics()
+
+def timed(name, **labels):
+    # Koristin sekä tavallisille että async-funktioille
+    def decorate(fn):
+        if inspect.iscoroutinefunction(fn):
+            async def wrapper(*args, **kwargs):
+                with metrics.timer(name, **labels):
+                    return await fn(*args, **kwargs)
+        else:
+            def wrapper(*args, **kwargs):
+                with metrics.timer(name, **labels):
+                    return fn(*args, **kwargs)
+        return functools.wraps(fn)(wrapper)
+    return decorate
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(port=METRICS_PORT, host=METRICS_HOST):
+    # Flet omistaa sovelluksen HTTP-palvelimen, joten /metrics tarjotaan sen vieressä
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+# --- YHTEYSPOOLI ---
+class PoolTimeout(Exception):
+    pass
+
+class ConnectionPool:
+    # Prosessin yhteinen pooli: yhteydet avataan laiskasti, tarkistetaan lainattaessa
+    # ja kierrätetään kun ne ovat olleet liian kauan käyttämättä tai ovat liian vanhoja.
+    def __init__(self, connect, min_size=DB_POOL_MIN, max_size=DB_POOL_MAX, timeout=DB_POOL_TIMEOUT,
+                 max_idle=DB_POOL_MAX_IDLE, max_lifetime=DB_POOL_MAX_LIFETIME, check_after=DB_POOL_CHECK_AFTER):
+        self.connect = connect
+        self.min_size = min(min_size, max_size)
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.check_after = check_after
+
+        self._cond = threading.Condition()
+        self._idle = []       # [(conn, viimeksi palautettu)], viimeisin lopussa
+        self._created = {}    # id(conn) -> avausaika
+        self._size = 0        # avoimet + varatut paikat
+        self._in_use = 0
+        self._waiters = 0
+        self._reaper = None
+
+        self._checkouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._timeouts = 0
+        self._recycled = 0
+        self._failed_checks = 0
+
+    def _open(self):
+        with metrics.timer("diidelain_db_connect_seconds"):
+            conn = self.connect()
+        self._created[id(conn)] = time.monotonic()
+        return conn
+
+    def _close(self, conn):
+        self._created.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _expired(self, conn, now):
+        created = self._created.get(id(conn), now)
+        return now - created > self.max_lifetime
+
+    def _healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        now = time.monotonic()
+        if self._expired(conn, now) or now - last_used > self.max_idle:
+            self._recycled += 1
+            return False
+        if now - last_used > self.check_after:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1")
+                conn.rollback()
+            except Exception:
+                self._failed_checks += 1
+                return False
+        return True
+
+    def getconn(self):
+        start = time.monotonic()
+        self._start_reaper()
+        conn = None
+        last_used = None
+        with self._cond:
+            self._waiters += 1
+            try:
+                while True:
+                    if self._idle:
+                        conn, last_used = self._idle.pop()
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        break
+                    remaining = start + self.timeout - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise PoolTimeout(f"Tietokantayhteyttä ei saatu {self.timeout:.0f} sekunnissa")
+                    self._cond.wait(remaining)
+            finally:
+                self._waiters -= 1
+            self._in_use += 1
+
+        # Avaus ja tarkistus tehdään lukon ulkopuolella, paikka on jo varattu
+        try:
+            if conn is not None and not self._healthy(conn, last_used):
+                self._close(conn)
+                conn = None
+            if conn is None:
+                conn = self._open()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+        waited = time.monotonic() - start
+        metrics.observe("diidelain_db_pool_wait_seconds", waited)
+        with self._cond:
+            self._checkouts += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        return conn
+
+    def putconn(self, conn, discard=False):
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except Exception:
+                discard = True
+        now = time.monotonic()
+        if discard or conn.closed or self._expired(conn, now):
+            self._close(conn)
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            return
+        with self._cond:
+            self._idle.append((conn, now))
+            self._in_use -= 1
+            self._cond.notify()
+
+    def _start_reaper(self):
+        if self._reaper is not None:
+            return
+        with self._cond:
+            if self._reaper is not None:
+                return
+            self._reaper = threading.Thread(target=self._reap_loop, name="db-pool-reaper", daemon=True)
+            self._reaper.start()
+
+    def _reap_loop(self):
+        interval = max(1.0, min(self.max_idle, self.max_lifetime) / 2)
+        while True:
+            time.sleep(interval)
+            try:
+                self.reap()
+            except Exception as e:
+                print("Virhe poolin siivouksessa:", e)
+
+    def reap(self):
+        # Suljetaan vanhentuneet vapaat yhteydet ja täydennetään minimikokoon
+        now = time.monotonic()
+        stale = []
+        with self._cond:
+            keep = []
+            for conn, last_used in self._idle:
+                if conn.closed or self._expired(conn, now) or now - last_used > self.max_idle:
+                    stale.append(conn)
+                else:
+                    keep.append((conn, last_used))
+            self._idle = keep
+            self._size -= len(stale)
+            self._recycled += len(stale)
+            missing = max(0, self.min_size - self._size)
+            self._size += missing
+        for conn in stale:
+            self._close(conn)
+        for opened in range(missing):
+            try:
+                conn = self._open()
+            except Exception:
+                # Vapautetaan kaikki täyttämättä jääneet paikat, ei vain epäonnistunutta
+                with self._cond:
+                    self._size -= missing - opened
+                    self._cond.notify_all()
+                raise
+            with self._cond:
+                self._idle.insert(0, (conn, time.monotonic()))
+                self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+        for conn, _ in idle:
+            self._close(conn)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "size": self._size,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "waiters": self._waiters,
+                "checkouts": self._checkouts,
+                "wait_avg_ms": (self._wait_total / self._checkouts * 1000) if self._checkouts else 0.0,
+                "wait_max_ms": self._wait_max * 1000,
+                "timeouts": self._timeouts,
+                "recycled": self._recycled,
+                "failed_checks": self._failed_checks,
+            }
+
+# --- KATKAISIN ---
+class DatabaseUnavailable(Exception):
+    pass
+
+# Yhteys-, aikaraja- ja poolivirheet kertovat kannan tilasta; muut (esim. eheysvirheet) eivät.
+# SQLiten OperationalError tulee myös SQL-virheistä, joten siitä lasketaan vain lukitus.
+TRANSIENT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError, PoolTimeout)
+SQLITE_TRANSIENT = ("database is locked", "database is busy", "database table is locked")
+
+def is_transient(e):
+    if isinstance(e, sqlite3.OperationalError):
+        return str(e).startswith(SQLITE_TRANSIENT)
+    return isinstance(e, TRANSIENT_ERRORS)
+
+class CircuitBreaker:
+    # Peräkkäiset yhteysvirheet avaavat katkaisimen: kutsut hylätään heti reset_after
+    # sekunnin ajan, jonka jälkeen seuraavat kutsut saavat yrittää. Onnistuminen
+    # sulkee katkaisimen, epäonnistuminen avaa sen heti uudelleen.
+    def __init__(self, threshold=DB_BREAKER_THRESHOLD, reset_after=DB_BREAKER_RESET):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._local = threading.local()
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+    def check(self):
+        opened_at = self._opened_at
+        if opened_at is not None and time.monotonic() - opened_at < self.reset_after:
+            metrics.inc("diidelain_db_breaker_rejected_total")
+            raise DatabaseUnavailable("Tietokanta ei vastaa, yritetään hetken päästä uudelleen")
+
+    def success(self):
+        if self._failures == 0 and self._opened_at is None:
+            return
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def failure(self):
+        if getattr(self._local, "deferred", False):
+            self._local.failed = True
+            return
+        with self._lock:
+            self._failures += 1
+            if not self.threshold or self._failures < self.threshold:
+                return
+            if self._opened_at is None:
+                metrics.inc("diidelain_db_breaker_opened_total")
+            self._opened_at = time.monotonic()
+
+    @contextmanager
+    def single_call(self):
+        # Uusittu kutsu lasketaan yhdeksi epäonnistumiseksi: yritysten virheet
+        # kirjataan vasta, kun viimeinenkin yritys epäonnistui
+        if getattr(self._local, "deferred", False):
+            yield
+            return
+        self._local.deferred, self._local.failed = True, False
+        try:
+            yield
+        except BaseException as e:
+            self._local.deferred = False
+            if self._local.failed and is_transient(e):
+                self.failure()
+            raise
+        finally:
+            self._local.deferred = False
+
+    def stats(self):
+        return {"open": int(self.is_open), "failures": self._failures}
+
+# --- SQLITE ---
+# Päivämäärät ja totuusarvot palautetaan samoina tyyppeinä kuin psycopg2:lta
+def _sqlite_date(b):
+    # Ennen tarkistusta tallennetut virheelliset päivät luetaan tyhjinä
+    try:
+        return date.fromisoformat(b.decode())
+    except ValueError:
+        return None
+
+sqlite3.register_adapter(date, date.isoformat)
+sqlite3.register_converter("DATE", _sqlite_date)
+sqlite3.register_converter("BOOLEAN", lambda b: b != b"0")
+sqlite3.register_adapter(datetime, lambda v: v.isoformat(" "))
+sqlite3.register_converter("TIMESTAMP", lambda b: datetime.fromisoformat(b.decode()) if b else None)
+
+class SQLiteCursor:
+    # psycopg2:n kaltainen kursori: %s-paikkamerkit ja with-lohko
+    def __init__(self, cur, connection):
+        self._cur = cur
+        self.connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._cur.close()
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+    def __iter__(self):
+        return iter(self._cur)
+
+    def execute(self, sql, params=()):
+        with self.connection.statement():
+            self._cur.execute(sql.replace("%s", "?"), params)
+
+    def executemany(self, sql, seq):
+        with self.connection.statement():
+            self._cur.executemany(sql.replace("%s", "?"), seq)
+
+class SQLiteConnection:
+    # Poolin kautta yhteys on kerrallaan vain yhden säikeen käytössä
+    def __init__(self, path, timeout=SQLITE_BUSY_TIMEOUT, statement_timeout=DB_STATEMENT_TIMEOUT):
+        self._conn = sqlite3.connect(path, timeout=timeout, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        self.closed = False
+        # Transaktion muutosilmoitukset lähetetään vasta commitin jälkeen
+        self.pending = []
+        self.on_commit = None
+        # Kyselyn aikaraja kuten Postgresin statement_timeout: edistymiskäsittelijä
+        # keskeyttää kyselyn, kun raja ylittyy. Transaktio voi poistaa rajan (lift_timeout).
+        self.default_timeout = statement_timeout
+        self.statement_timeout = statement_timeout
+        self._deadline = None
+        if statement_timeout:
+            self._conn.set_progress_handler(self._past_deadline, 10000)
+
+    def _past_deadline(self):
+        return self._deadline is not None and time.monotonic() > self._deadline
+
+    @contextmanager
+    def statement(self):
+        self._deadline = time.monotonic() + self.statement_timeout if self.statement_timeout else None
+        try:
+            yield
+        except sqlite3.OperationalError as e:
+            if str(e) != "interrupted":
+                raise
+            raise psycopg2.extensions.QueryCanceledError("Kysely keskeytettiin aikarajan ylittyessä") from e
+
+    def lift_timeout(self):
+        self.statement_timeout = None
+
+    def cursor(self):
+        return SQLiteCursor(self._conn.cursor(), self)
+
+    def get_transaction_status(self):
+        # Pooli tarkistaa tämän palautettaessa kuten psycopg2-yhteydeltä
+        if self._conn.in_transaction:
+            return psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+        return psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def commit(self):
+        self._conn.commit()
+        self.statement_timeout = self.default_timeout
+        pending, self.pending = self.pending, []
+        if self.on_commit:
+            for payload in pending:
+                self.on_commit(payload)
+
+    def rollback(self):
+        self.pending = []
+        self.statement_timeout = self.default_timeout
+        self._conn.rollback()
+
+    def close(self):
+        self.closed = True
+        self._conn.close()
+
+def export_value(value, fmt):
+    # Samat arvot kuin Postgresin COPY:ssä ja row_to_json:ssa
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, bool) and fmt == "csv":
+        return "t" if value else "f"
+    return value
+
 # --- TIETOKANTA ---
 class TaskManager:
+    # Moottorista riippumaton osa: kaikki kyselyt, joiden SQL on sama Postgresissa ja
+    # SQLitessä. Aliluokat toteuttavat yhteydet, skeemalukon, listaparametrit,
+    # erälisäyksen sekä tuonnin ja viennin.
+    dialect = None
+    IN_LIST = "= ANY(%s)"
+    # Arkistoinnin raja: tehty yli %s päivää sitten
+    ARCHIVE_CUTOFF = "now() - make_interval(days => %s)"
+    TASK_ORDER = "t.deadline ASC, t.id ASC"
+    # Tehtävärivit: (id, sisältö, kategoria, deadline, tehty, kuvaus, versio)
+    TASK_COLUMNS = "t.id, t.content, c.name, t.deadline, t.completed, t.description, t.version"
+
+    def __init__(self):
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        # Kasvaa jokaisen kategoriakirjoituksen jälkeen, ks. CategoryCache
+        self.category_version = 0
+        self._version_lock = threading.Lock()
+        self._change_listeners = []
+        self._listener = None
+        self.breaker = CircuitBreaker()
+
     def get_connection(self):
-        if not DATABASE_URL or "LIITÄ" in DATABASE_URL:
-            raise Exception("DATABASE_URL puuttuu! Aseta se app.py riville 8.")
-        return psycopg2.connect(DATABASE_URL, sslmode='require')
+        raise NotImplementedError
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = ConnectionPool(self.get_connection)
+        return self._pool
+
+    def pool_stats(self):
+        return self.pool.stats()
+
+    def _categories_changed(self):
+        with self._version_lock:
+            self.category_version += 1
+
+    def add_change_listener(self, fn):
+        # fn(muutos) kutsutaan jokaisesta tallennetusta muutoksesta, myös muiden
+        # prosessien tekemistä; muutos on {"tasks": [id]}, {"categories": True} tai {"reload": True}
+        self._change_listeners.append(fn)
+        self._start_listener()
+
+    def remove_change_listener(self, fn):
+        if fn in self._change_listeners:
+            self._change_listeners.remove(fn)
+
+    def _start_listener(self):
+        pass
 
-    def create_tables(self):
-        conn = None
+    def _notify(self, cur, tasks=(), categories=False, reload=False):
+        raise NotImplementedError
+
+    def _dispatch(self, payload):
         try:
-            conn = self.get_connection()
-            with conn.cursor() as cur:
-                cur.execute("""
-                CREATE TABLE IF NOT EXISTS tasks (
-                    id SERIAL PRIMARY KEY,
-                    content TEXT,
-                    category TEXT,
-                    deadline DATE,
-                    completed BOOLEAN DEFAULT FALSE
-                )
-                """)
-                try:
-                    cur.execute("ALTER TABLE tasks ADD COLUMN description TEXT")
-                    conn.commit()
-                except:
-                    conn.rollback()
+            change = json.loads(payload)
+        except ValueError:
+            return
+        if change.get("categories"):
+            self._categories_changed()
+        for fn in self._change_listeners:
+            try:
+                fn(change)
+            except Exception as e:
+                print("Virhe muutosilmoituksen käsittelyssä:", e)
+
+    @contextmanager
+    def connection(self):
+        # Lainaa yhteyden poolista: commit onnistuessa, rollback virheessä. Katkaisin
+        # laskee yhteys- ja aikarajavirheet ja hylkää kutsun heti, kun se on auki.
+        self.breaker.check()
+        try:
+            conn = self.pool.getconn()
+        except Exception as e:
+            if is_transient(e):
+                self.breaker.failure()
+            raise
+        discard = False
+        try:
+            yield conn
+            conn.commit()
+        except BaseException as e:
+            if is_transient(e):
+                self.breaker.failure()
+            try:
+                conn.rollback()
+            except Exception:
+                discard = True
+            raise
+        else:
+            self.breaker.success()
+        finally:
+            self.pool.putconn(conn, discard=discard)
 
+    def _list_param(self, values):
+        return list(values)
+
+    def _lock_schema(self, cur):
+        raise NotImplementedError
+
+    def _lift_timeout(self, cur):
+        # Skeemamuutokset, tuonti ja vienti saavat kestää kyselyn aikarajaa pidempään
+        cur.execute("SET LOCAL statement_timeout = 0")
+
+    def migrate(self):
+        # Ajetaan kerran prosessin käynnistyessä. Skeemalukko estää rinnakkaisia
+        # workereita ajamasta samoja muutoksia yhtä aikaa; kaikki uudet versiot
+        # ajetaan samassa transaktiossa.
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                self._lift_timeout(cur)
+                self._lock_schema(cur)
                 cur.execute("""
-                CREATE TABLE IF NOT EXISTS master_categories (
-                    id SERIAL PRIMARY KEY,
-                    name TEXT UNIQUE,
-                    color TEXT,
-                    icon_name TEXT
-                )
-                """)
-                cur.execute("""
-                CREATE TABLE IF NOT EXISTS categories (
-                    id SERIAL PRIMARY KEY,
-                    name TEXT UNIQUE,
-                    color TEXT,
-                    icon_name TEXT,
-                    master_id INTEGER REFERENCES master_categories(id)
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT,
+                    applied_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
                 )
                 """)
-                
-                cur.execute("SELECT count(*) FROM categories")
-                if cur.fetchone()[0] == 0:
-                    defaults = [
-                        ("Työ", "#F96635", "Työ"),
-                        ("Koulu", "#F9A822", "Koulu"),
-                        ("Muu", "#93D3AE", "Muu")
-                    ]
-                    for name, color, icon in defaults:
-                        cur.execute("INSERT INTO categories (name, color, icon_name) VALUES (%s, %s, %s)", (name, color, icon))
-            conn.commit()
-        except Exception as e:
-            print("Virhe taulujen luonnissa:", e)
-        finally:
-            if conn: conn.close()
+                cur.execute("SELECT coalesce(max(version), 0) FROM schema_version")
+                current = cur.fetchone()[0]
+                for version, description, postgres_step, sqlite_step in MIGRATIONS:
+                    if version <= current:
+                        continue
+                    step = sqlite_step if self.dialect == "sqlite" else postgres_step
+                    if step:
+                        step(cur)
+                    cur.execute("INSERT INTO schema_version (version, description) VALUES (%s, %s)", (version, description))
+                    print(f"Tietokanta päivitetty versioon {version}: {description}")
+        self._categories_changed()
 
     # --- PÄÄKATEGORIAT ---
     def get_master_categories(self):
-        conn = self.get_connection()
-        try:
+        with self.connection() as conn:
             with conn.cursor() as cur:
                 cur.execute("SELECT id, name, color, icon_name FROM master_categories ORDER BY id ASC")
                 return cur.fetchall()
-        finally:
-            conn.close()
 
     def add_master_category(self, name, color, icon_name):
-        conn = self.get_connection()
-        try:
+        with self.connection() as conn:
             with conn.cursor() as cur:
                 cur.execute("INSERT INTO master_categories (name, color, icon_name) VALUES (%s, %s, %s)", (name, color, icon_name))
-            conn.commit()
-        finally:
-            conn.close()
+                self._notify(cur, categories=True)
+        self._categories_changed()
 
     def update_master_category(self, m_id, name, color, icon_name):
-        conn = self.get_connection()
-        try:
+        with self.connection() as conn:
             with conn.cursor() as cur:
                 cur.execute("UPDATE master_categories SET name=%s, color=%s, icon_name=%s WHERE id=%s", (name, color, icon_name, m_id))
-            conn.commit()
-        finally:
-            conn.close()
-            
+                self._notify(cur, categories=True)
+        self._categories_changed()
+
     def delete_master_category(self, m_id):
-        conn = self.get_connection()
-        try:
+        with self.connection() as conn:
             with conn.cursor() as cur:
                 cur.execute("UPDATE categories SET master_id = NULL WHERE master_id = %s", (m_id,))
                 cur.execute("DELETE FROM master_categories WHERE id = %s", (m_id,))
-            conn.commit()
-        finally:
-            conn.close()
+                self._notify(cur, categories=True)
+        self._categories_changed()
 
     # --- KATEGORIAT ---
     def get_categories(self):
-        conn = self.get_connection()
-        try:
+        with self.connection() as conn:
             with conn.cursor() as cur:
                 cur.execute("SELECT id, name, color, icon_name, master_id FROM categories ORDER BY id ASC")
                 return cur.fetchall()
-        finally:
-            conn.close()
 
     def add_category(self, name, color, icon_name, master_id):
-        conn = self.get_connection()
-        try:
+        with self.connection() as conn:
             with conn.cursor() as cur:
                 cur.execute("INSERT INTO categories (name, color, icon_name, master_id) VALUES (%s, %s, %s, %s)", 
                            (name, color, icon_name, master_id))
-            conn.commit()
-        finally:
-            conn.close()
+                self._notify(cur, categories=True)
+        self._categories_changed()
 
     def update_category(self, old_name, new_name, color, icon_name, master_id):
-        conn = self.get_connection()
-        try:
+        with self.connection() as conn:
             with conn.cursor() as cur:
+                # Tehtävät viittaavat category_id:hen, joten uudelleennimeäminen koskee yhtä riviä
                 cur.execute("UPDATE categories SET name=%s, color=%s, icon_name=%s, master_id=%s WHERE name=%s", 
                            (new_name, color, icon_name, master_id, old_name))
-                if old_name != new_name:
-                    cur.execute("UPDATE tasks SET category=%s WHERE category=%s", (new_name, old_name))
-            conn.commit()
-        finally:
-            conn.close()
+                self._notify(cur, categories=True)
+        self._categories_changed()
 
     def delete_category(self, name):
-        conn = self.get_connection()
-        try:
+        with self.connection() as conn:
             with conn.cursor() as cur:
-                cur.execute("UPDATE tasks SET category='Muu' WHERE category=%s", (name,))
+                for table in ("tasks", "tasks_archive"):
+                    cur.execute(f"""
+                    UPDATE {table} SET category_id = (SELECT id FROM categories WHERE name = 'Muu')
+                    WHERE category_id = (SELECT id FROM categories WHERE name = %s)
+                    """, (name,))
                 cur.execute("DELETE FROM categories WHERE name=%s", (name,))
-            conn.commit()
-        finally:
-            conn.close()
+                self._notify(cur, categories=True)
+        self._categories_changed()
 
     # --- TEHTÄVÄT ---
     def add_task(self, content, category, deadline, description):
         db_date = date_fi_to_db(deadline)
-        conn = self.get_connection()
-        try:
+        with self.connection() as conn:
             with conn.cursor() as cur:
-                cur.execute("INSERT INTO tasks (content, category, deadline, description) VALUES (%s, %s, %s, %s)", 
+                cur.execute("INSERT INTO tasks (content, category_id, deadline, description) VALUES (%s, (SELECT id FROM categories WHERE name = %s), %s, %s) RETURNING id", 
                            (content, category, db_date, description))
-            conn.commit()
-        finally:
-            conn.close()
+                task_id = cur.fetchone()[0]
+                self._notify(cur, tasks=[task_id])
+        return task_id
 
     def update_task(self, task_id, content, category, deadline, description):
         db_date = date_fi_to_db(deadline)
-        conn = self.get_connection()
-        try:
+        with self.connection() as conn:
             with conn.cursor() as cur:
-                cur.execute("UPDATE tasks SET content=%s, category=%s, deadline=%s, description=%s WHERE id=%s", 
+                cur.execute("UPDATE tasks SET content=%s, category_id=(SELECT id FROM categories WHERE name = %s), deadline=%s, description=%s WHERE id=%s", 
                            (content, category, db_date, description, task_id))
-            conn.commit()
-        finally:
-            conn.close()
+                self._notify(cur, tasks=[task_id])
+
+    def get_tasks(self, category_filter="Kaikki", sub_categories=None, master_id=None, category_id=None, after=None, limit=None):
+        # Kaikki suodatus tehdään WHERE-ehdossa. Sivutus on avainjoukkoon perustuva:
+        # after=(deadline, id) on edellisen sivun viimeinen rivi, limit sivun koko.
+        where = []
+        params = []
+        if category_id is not None:
+            where.append("t.category_id = %s")
+            params.append(category_id)
+        elif sub_categories:
+            where.append(f"t.category_id IN (SELECT id FROM categories WHERE name {self.IN_LIST})")
+            params.append(self._list_param(sub_categories))
+        elif master_id is not None:
+            where.append("t.category_id IN (SELECT id FROM categories WHERE master_id = %s)")
+            params.append(master_id)
+        elif category_filter and category_filter != "Kaikki":
+            where.append("t.category_id = (SELECT id FROM categories WHERE name = %s)")
+            params.append(category_filter)
+
+        return self._select_tasks(where, params, after, limit)
+
+    def get_overdue_tasks(self, today=None, after=None, limit=None):
+        # Avoimet tehtävät, joiden deadline on ohitettu
+        return self.get_due_tasks(None, today or date.today(), after=after, limit=limit)
+
+    def get_due_tasks(self, start, end, after=None, limit=None):
+        # Avoimet tehtävät, joiden deadline on välillä [start, end); start=None = ei alarajaa.
+        # Ehto completed = false vastaa osittaista hakemistoa, joten tehdyt eivät hidasta hakua.
+        # Deadline on aina asetettu, joten järjestys on suoraan hakemiston järjestys.
+        where = ["t.completed = false", "t.deadline < %s"]
+        params = [end]
+        if start is not None:
+            where.append("t.deadline >= %s")
+            params.append(start)
+        return self._select_tasks(where, params, after, limit, order="t.deadline, t.id")
+
+    def _select_tasks(self, where, params, after=None, limit=None, order=None):
+        if after is not None:
+            after_deadline, after_id = after
+            # deadline ASC lajittelee NULL-arvot viimeiseksi
+            if after_deadline is None:
+                where.append("t.deadline IS NULL AND t.id > %s")
+                params.append(after_id)
+            else:
+                where.append("((t.deadline, t.id) > (%s, %s) OR t.deadline IS NULL)")
+                params.extend([after_deadline, after_id])
+
+        query = f"""
+        SELECT {self.TASK_COLUMNS}
+        FROM tasks t LEFT JOIN categories c ON c.id = t.category_id
+        """
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += f" ORDER BY {order or self.TASK_ORDER}"
+        if limit is not None:
+            query += " LIMIT %s"
+            params.append(limit)
+
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(query, params)
+                return cur.fetchall()
 
-    def get_tasks(self, category_filter="Kaikki", sub_categories=None):
-        conn = self.get_connection()
-        try:
+    def get_task_counts(self, today=None):
+        # Avoimet ja myöhässä olevat tehtävät kategorioittain yhdellä koostekyselyllä:
+        # {category_id: (avoimet, myöhässä)}
+        today = today or date.today()
+        with self.connection() as conn:
             with conn.cursor() as cur:
-                if sub_categories:
-                    placeholders = '%s,' * len(sub_categories)
-                    placeholders = placeholders[:-1]
-                    query = f"SELECT id, content, category, deadline, completed, description FROM tasks WHERE category IN ({placeholders}) ORDER BY deadline ASC"
-                    cur.execute(query, tuple(sub_categories))
-                else:
-                    cur.execute("SELECT id, content, category, deadline, completed, description FROM tasks ORDER BY deadline ASC")
-                
-                all_tasks = cur.fetchall()
-            
-            if not sub_categories and category_filter and category_filter != "Kaikki":
-                return [t for t in all_tasks if t[2] == category_filter]
-            return all_tasks
-        finally:
-            conn.close()
+                cur.execute("""
+                SELECT category_id, count(*), count(*) FILTER (WHERE deadline < %s)
+                FROM tasks WHERE completed = false GROUP BY category_id
+                """, (today,))
+                return {row[0]: (row[1], row[2]) for row in cur.fetchall()}
+
+    def get_change_token(self):
+        # Muuttuu aina, kun jokin tehtävä lisätään, muuttuu tai poistetaan
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT counter FROM task_changes WHERE id = 1")
+                return cur.fetchone()[0]
+
+    def search_tasks(self, query, limit=TASK_PAGE_SIZE, offset=0):
+        # Osuvuusjärjestyksessä; jokainen sana on sanan alku ja kaikkien on löydyttävä
+        raise NotImplementedError
+
+    def get_tasks_by_ids(self, task_ids):
+        # Muuttuneiden rivien haku muutosilmoituksen perusteella; poistetut puuttuvat tuloksesta
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(f"""
+                SELECT {self.TASK_COLUMNS}
+                FROM tasks t LEFT JOIN categories c ON c.id = t.category_id
+                WHERE t.id {self.IN_LIST}
+                """, (self._list_param(task_ids),))
+                return cur.fetchall()
 
     def toggle_task(self, task_id, current_status):
         new_status = not current_status
-        conn = self.get_connection()
-        try:
+        with self.connection() as conn:
             with conn.cursor() as cur:
                 cur.execute("UPDATE tasks SET completed = %s WHERE id = %s", (new_status, task_id))
-            conn.commit()
-        finally:
-            conn.close()
+                self._notify(cur, tasks=[task_id])
     
     def delete_task(self, task_id):
-        conn = self.get_connection()
-        try:
+        with self.connection() as conn:
             with conn.cursor() as cur:
                 cur.execute("DELETE FROM tasks WHERE id = %s", (task_id,))
-            conn.commit()
-        finally:
-            conn.close()
+                self._notify(cur, tasks=[task_id])
+
+    # --- TUONTI JA VIENTI ---
+    def _copy_out(self, select, out, fmt):
+        raise NotImplementedError
+
+    def export_tasks(self, out, fmt="csv"):
+        # Varmuuskopio sisältää myös arkistoidut; tuotuina ne palaavat arkistoon siirtäjän kautta
+        self._copy_out("""
+        SELECT t.id, t.content, c.name AS category, t.deadline, t.completed, t.description
+        FROM tasks t LEFT JOIN categories c ON c.id = t.category_id
+        UNION ALL
+        SELECT a.id, a.content, c.name, a.deadline, true, a.description
+        FROM tasks_archive a LEFT JOIN categories c ON c.id = a.category_id
+        ORDER BY 1
+        """, out, fmt)
+
+    def export_categories(self, out, fmt="csv"):
+        self._copy_out("""
+        SELECT c.name, c.color, c.icon_name, m.name AS master
+        FROM categories c LEFT JOIN master_categories m ON m.id = c.master_id ORDER BY c.id
+        """, out, fmt)
+
+    def import_tasks(self, src, fmt="csv"):
+        raise NotImplementedError
+
+    def import_categories(self, src, fmt="csv"):
+        raise NotImplementedError
+
+    # --- JOUKKOTOIMINNOT ---
+    def toggle_tasks(self, task_ids, status):
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(f"UPDATE tasks SET completed = %s WHERE id {self.IN_LIST}", (status, self._list_param(task_ids)))
+                self._notify(cur, tasks=task_ids)
+                return cur.rowcount
+
+    def delete_tasks(self, task_ids):
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(f"DELETE FROM tasks WHERE id {self.IN_LIST}", (self._list_param(task_ids),))
+                self._notify(cur, tasks=task_ids)
+                return cur.rowcount
+
+    def move_tasks(self, task_ids, category):
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(f"UPDATE tasks SET category_id = (SELECT id FROM categories WHERE name = %s) WHERE id {self.IN_LIST}",
+                            (category, self._list_param(task_ids)))
+                self._notify(cur, tasks=task_ids)
+                return cur.rowcount
+
+    def apply_task_writes(self, inserts=(), updates=(), toggles=(), deletes=()):
+        # Kirjoitusjonon erä yhdessä transaktiossa; palauttaa lisättyjen rivien id:t
+        new_ids = []
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                if inserts:
+                    new_ids = self._insert_tasks(cur, inserts)
+                if updates:
+                    cur.executemany("UPDATE tasks SET content=%s, category_id=(SELECT id FROM categories WHERE name = %s), deadline=%s, description=%s WHERE id=%s", updates)
+                if toggles:
+                    cur.executemany("UPDATE tasks SET completed = %s WHERE id = %s", toggles)
+                if deletes:
+                    cur.executemany("DELETE FROM tasks WHERE id = %s", [(t_id,) for t_id in deletes])
+                self._notify(cur, tasks=new_ids + [u[-1] for u in updates] + [t[1] for t in toggles] + list(deletes))
+        return new_ids
+
+    def _insert_tasks(self, cur, inserts):
+        raise NotImplementedError
+
+    # --- ARKISTO ---
+    def archive_completed(self, days=ARCHIVE_AFTER_DAYS, batch=ARCHIVE_BATCH):
+        # Siirtää yli days päivää sitten tehdyt tehtävät tasks_archive-tauluun; palauttaa siirretyt id:t.
+        # Ehto toistetaan siirrossa, jotta välissä avattu tehtävä jää paikalleen.
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(f"""
+                SELECT id FROM tasks WHERE completed = true AND completed_at < {self.ARCHIVE_CUTOFF}
+                ORDER BY completed_at LIMIT %s
+                """, (days, batch))
+                task_ids = [row[0] for row in cur.fetchall()]
+                if not task_ids:
+                    return []
+                cur.execute(f"""
+                INSERT INTO tasks_archive (id, content, category_id, deadline, description, version, completed_at)
+                SELECT id, content, category_id, deadline, description, version, completed_at
+                FROM tasks WHERE id {self.IN_LIST} AND completed = true
+                """, (self._list_param(task_ids),))
+                cur.execute(f"DELETE FROM tasks WHERE id {self.IN_LIST} AND completed = true", (self._list_param(task_ids),))
+                self._notify(cur, tasks=task_ids)
+                return task_ids
+
+    def get_archived_tasks(self, after=None, limit=TASK_PAGE_SIZE):
+        # Uusimmat ensin; after=(completed_at, id) on edellisen sivun viimeinen rivi (8. sarake)
+        where, params = "", []
+        if after is not None:
+            where = "WHERE (a.completed_at, a.id) < (%s, %s)"
+            params.extend(after)
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(f"""
+                SELECT a.id, a.content, c.name, a.deadline, true, a.description, a.version, a.completed_at
+                FROM tasks_archive a LEFT JOIN categories c ON c.id = a.category_id
+                {where}
+                ORDER BY a.completed_at DESC, a.id DESC LIMIT %s
+                """, params + [limit])
+                return cur.fetchall()
+
+# Näitä ei ajasteta: connection() on kontekstimanageri, yhteyden avaus ajastetaan poolissa
+UNTIMED_METHODS = {"connection", "get_connection", "pool_stats"}
+# Idempotentit luvut, jotka saa uusia ohimenevän virheen jälkeen
+READ_METHODS = {
+    "get_master_categories", "get_categories", "get_tasks", "get_overdue_tasks", "get_due_tasks",
+    "get_task_counts", "get_change_token", "search_tasks", "get_tasks_by_ids", "get_archived_tasks"
+}
+
+def retry_read(fn):
+    # Uusinta satunnaistetulla eksponentiaalisella viiveellä (full jitter). Aikarajan
+    # ylittänyttä kyselyä ja poolin aikakatkaisua ei uusita, ettei viive moninkertaistu,
+    # eikä auki olevaa katkaisinta yritetä ohittaa.
+    @functools.wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        attempt = 0
+        with self.breaker.single_call():
+            while True:
+                try:
+                    return fn(self, *args, **kwargs)
+                except (psycopg2.extensions.QueryCanceledError, PoolTimeout):
+                    raise
+                except Exception as e:
+                    if not is_transient(e) or attempt >= DB_READ_RETRIES or self.breaker.is_open:
+                        raise
+                metrics.inc("diidelain_db_retries_total")
+                time.sleep(random.uniform(0, DB_RETRY_BASE * 2 ** attempt))
+                attempt += 1
+    return wrapper
+
+def retried(cls):
+    for name in READ_METHODS:
+        setattr(cls, name, retry_read(getattr(cls, name)))
+    return cls
+
+def instrumented(cls):
+    # Ajastaa luokan julkiset metodit, myös perusluokasta perityt
+    for name in dir(cls):
+        fn = getattr(cls, name)
+        if name.startswith("_") or name in UNTIMED_METHODS or not inspect.isfunction(fn):
+            continue
+        setattr(cls, name, timed("diidelain_db_seconds", method=name)(fn))
+    return cls
+
+@instrumented
+@retried
+class PostgresTaskManager(TaskManager):
+    dialect = "postgres"
+
+    def get_connection(self):
+        if not DATABASE_URL or "LIITÄ" in DATABASE_URL:
+            raise Exception("DATABASE_URL puuttuu! Aseta se app.py riville 8.")
+        # Osoitteen omat options-asetukset (esim. search_path) säilytetään
+        options = psycopg2.extensions.parse_dsn(DATABASE_URL).get("options", "")
+        options = f"{options} -c statement_timeout={int(DB_STATEMENT_TIMEOUT * 1000)}".strip()
+        return psycopg2.connect(DATABASE_URL, sslmode=DB_SSLMODE, connect_timeout=DB_CONNECT_TIMEOUT,
+                                options=options)
+
+    def _lock_schema(self, cur):
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_ID,))
+
+    def search_tasks(self, query, limit=TASK_PAGE_SIZE, offset=0):
+        terms = search_terms(query)
+        if not terms:
+            return []
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(f"""
+                SELECT {self.TASK_COLUMNS}
+                FROM tasks t CROSS JOIN to_tsquery('finnish', %s) q
+                LEFT JOIN categories c ON c.id = t.category_id
+                WHERE t.search @@ q
+                ORDER BY ts_rank(t.search, q) DESC, t.id
+                LIMIT %s OFFSET %s
+                """, (" & ".join(f"{term}:*" for term in terms), limit, offset))
+                return cur.fetchall()
+
+    def _notify(self, cur, tasks=(), categories=False, reload=False):
+        # pg_notify toimitetaan kuuntelijoille vasta commitissa, peruttu transaktio ei ilmoita.
+        # Jokainen kirjoitus päättyy tähän, joten laskuririvi lukitaan aina viimeisenä eikä
+        # sen haltija jää odottamaan tehtävärivejä (SQLitessa triggerit, kirjoituslukko on yhteinen).
+        cur.execute("UPDATE task_changes SET counter = counter + 1 WHERE id = 1")
+        for payload in change_payloads(tasks, categories, reload):
+            cur.execute("SELECT pg_notify(%s, %s)", (NOTIFY_CHANNEL, payload))
+
+    def _start_listener(self):
+        with self._pool_lock:
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._listen, name="db-listener", daemon=True)
+                self._listener.start()
+
+    def _listen(self):
+        # Oma yhteys poolin ulkopuolella, koska LISTEN varaa sen koko prosessin ajaksi.
+        # Katkoksen aikana menetetyt ilmoitukset korvataan täydellä päivityksellä.
+        delay = 1
+        reconnect = False
+        while True:
+            conn = None
+            try:
+                conn = self.get_connection()
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(psycopg2.sql.SQL("LISTEN {}").format(psycopg2.sql.Identifier(NOTIFY_CHANNEL)))
+                if reconnect:
+                    self._dispatch(json.dumps({"categories": True, "reload": True}))
+                delay = 1
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self._dispatch(conn.notifies.pop(0).payload)
+            except Exception as e:
+                print("Virhe muutosilmoitusten kuuntelussa:", e)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+            reconnect = True
+            time.sleep(delay)
+            delay = min(delay * 2, 30)
+
+    def _insert_tasks(self, cur, inserts):
+        rows = psycopg2.extras.execute_values(
+            cur, "INSERT INTO tasks (content, category_id, deadline, description, completed) VALUES %s RETURNING id",
+            inserts, template="(%s, (SELECT id FROM categories WHERE name = %s), %s, %s, %s)", fetch=True)
+        return [r[0] for r in rows]
+
+    def archive_completed(self, days=ARCHIVE_AFTER_DAYS, batch=ARCHIVE_BATCH):
+        # Yhtenä lauseena: lukitut rivit siirretään kokonaan, ja rinnakkaiset siirtäjät
+        # (muut workerit) ohittavat toistensa lukitsemat rivit
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(f"""
+                WITH moved AS (
+                    DELETE FROM tasks WHERE id IN (
+                        SELECT id FROM tasks WHERE completed = true AND completed_at < {self.ARCHIVE_CUTOFF}
+                        ORDER BY completed_at LIMIT %s FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING id, content, category_id, deadline, description, version, completed_at
+                )
+                INSERT INTO tasks_archive (id, content, category_id, deadline, description, version, completed_at)
+                SELECT * FROM moved
+                RETURNING id
+                """, (days, batch))
+                task_ids = [row[0] for row in cur.fetchall()]
+                if task_ids:
+                    self._notify(cur, tasks=task_ids)
+                return task_ids
+
+    def _copy_out(self, select, out, fmt):
+        if fmt == "ndjson":
+            sql = f"COPY (SELECT row_to_json(r) FROM ({select}) r) TO STDOUT WITH {NDJSON_COPY_OPTIONS}"
+        else:
+            sql = f"COPY ({select}) TO STDOUT WITH (FORMAT csv, HEADER true)"
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                self._lift_timeout(cur)
+                cur.copy_expert(sql, out)
+
+    def import_tasks(self, src, fmt="csv"):
+        # Rivit virtaavat väliaikaiseen tauluun COPY:llä ja siirretään yhdellä INSERTillä;
+        # tuntemattomat kategoriat menevät 'Muu'-kategoriaan
+        stream = CopyStream(task_import_row(rec) for rec in read_records(src, fmt))
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                self._lift_timeout(cur)
+                cur.execute("""
+                CREATE TEMP TABLE task_import (
+                    content TEXT, category TEXT, deadline DATE, completed BOOLEAN, description TEXT
+                ) ON COMMIT DROP
+                """)
+                cur.copy_expert("COPY task_import FROM STDIN WITH (FORMAT csv)", stream)
+                cur.execute("""
+                INSERT INTO tasks (content, category_id, deadline, completed, description)
+                SELECT s.content, coalesce(c.id, (SELECT id FROM categories WHERE name = 'Muu')),
+                       s.deadline, coalesce(s.completed, false), s.description
+                FROM task_import s LEFT JOIN categories c ON c.name = s.category
+                """)
+                count = cur.rowcount
+                self._notify(cur, reload=True)
+                return count
+
+    def import_categories(self, src, fmt="csv"):
+        stream = CopyStream(category_import_row(rec) for rec in read_records(src, fmt))
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                self._lift_timeout(cur)
+                cur.execute("""
+                CREATE TEMP TABLE category_import (
+                    name TEXT, color TEXT, icon_name TEXT, master TEXT
+                ) ON COMMIT DROP
+                """)
+                cur.copy_expert("COPY category_import FROM STDIN WITH (FORMAT csv)", stream)
+                cur.execute("""
+                INSERT INTO master_categories (name, color, icon_name)
+                SELECT DISTINCT master, 'None', 'Kansio' FROM category_import WHERE master IS NOT NULL
+                ON CONFLICT (name) DO NOTHING
+                """)
+                cur.execute("""
+                INSERT INTO categories (name, color, icon_name, master_id)
+                SELECT DISTINCT ON (s.name) s.name, s.color, s.icon_name, m.id
+                FROM category_import s LEFT JOIN master_categories m ON m.name = s.master
+                WHERE s.name IS NOT NULL
+                ON CONFLICT (name) DO UPDATE SET color = EXCLUDED.color, icon_name = EXCLUDED.icon_name, master_id = EXCLUDED.master_id
+                """)
+                count = cur.rowcount
+                self._notify(cur, categories=True)
+        self._categories_changed()
+        return count
+
+@instrumented
+@retried
+class SQLiteTaskManager(TaskManager):
+    # Sulautettu kanta yhden palvelimen asennuksiin ja paikalliseen kehitykseen.
+    # WAL-tilassa lukijat eivät odota kirjoittajaa.
+    dialect = "sqlite"
+    IN_LIST = "IN (SELECT value FROM json_each(%s))"
+    TASK_ORDER = "t.deadline IS NULL, t.deadline, t.id"
+    ARCHIVE_CUTOFF = "datetime('now', '-' || %s || ' days')"
+
+    def __init__(self, path=SQLITE_PATH):
+        super().__init__()
+        self.path = path
+
+    def get_connection(self):
+        conn = SQLiteConnection(self.path)
+        conn.on_commit = self._dispatch
+        return conn
+
+    def search_tasks(self, query, limit=TASK_PAGE_SIZE, offset=0):
+        terms = search_terms(query)
+        if not terms:
+            return []
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(f"""
+                SELECT {self.TASK_COLUMNS}
+                FROM tasks_fts f JOIN tasks t ON t.id = f.rowid
+                LEFT JOIN categories c ON c.id = t.category_id
+                WHERE tasks_fts MATCH %s
+                ORDER BY bm25(tasks_fts, 2.0, 1.0), t.id
+                LIMIT %s OFFSET %s
+                """, (" ".join(f'"{term}"*' for term in terms), limit, offset))
+                return cur.fetchall()
+
+    def _notify(self, cur, tasks=(), categories=False, reload=False):
+        # Yksi prosessi omistaa kannan, joten ilmoitukset jaetaan suoraan commitin jälkeen
+        cur.connection.pending.extend(change_payloads(tasks, categories, reload))
+
+    def _list_param(self, values):
+        return json.dumps(list(values))
 
-db = TaskManager()
+    def _lock_schema(self, cur):
+        cur.execute("BEGIN IMMEDIATE")
+
+    def _lift_timeout(self, cur):
+        cur.connection.lift_timeout()
+
+    def _insert_tasks(self, cur, inserts):
+        new_ids = []
+        for row in inserts:
+            cur.execute("INSERT INTO tasks (content, category_id, deadline, description, completed) VALUES (%s, (SELECT id FROM categories WHERE name = %s), %s, %s, %s)", row)
+            new_ids.append(cur.lastrowid)
+        return new_ids
+
+    def _copy_out(self, select, out, fmt):
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                self._lift_timeout(cur)
+                cur.execute(select)
+                names = [d[0] for d in cur.description]
+                writer = csv.writer(out, lineterminator="\n")
+                if fmt != "ndjson":
+                    writer.writerow(names)
+                while True:
+                    rows = cur.fetchmany(1000)
+                    if not rows:
+                        break
+                    for row in rows:
+                        values = [export_value(v, fmt) for v in row]
+                        if fmt == "ndjson":
+                            out.write(json.dumps(dict(zip(names, values)), ensure_ascii=False) + "\n")
+                        else:
+                            writer.writerow(values)
+
+    def import_tasks(self, src, fmt="csv"):
+        # Rivit luetaan virtana suoraan executemanylle
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                self._lift_timeout(cur)
+                cur.executemany("""
+                INSERT INTO tasks (content, category_id, deadline, completed, description)
+                VALUES (%s, coalesce((SELECT id FROM categories WHERE name = %s), (SELECT id FROM categories WHERE name = 'Muu')),
+                        %s, coalesce(%s, false), %s)
+                """, (task_import_row(rec) for rec in read_records(src, fmt)))
+                self._notify(cur, reload=True)
+                return cur.rowcount
+
+    def import_categories(self, src, fmt="csv"):
+        count = 0
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                self._lift_timeout(cur)
+                for name, color, icon_name, master in (category_import_row(rec) for rec in read_records(src, fmt)):
+                    if name is None:
+                        continue
+                    if master is not None:
+                        cur.execute("INSERT INTO master_categories (name, color, icon_name) VALUES (%s, 'None', 'Kansio') ON CONFLICT (name) DO NOTHING", (master,))
+                    cur.execute("""
+                    INSERT INTO categories (name, color, icon_name, master_id)
+                    VALUES (%s, %s, %s, (SELECT id FROM master_categories WHERE name = %s))
+                    ON CONFLICT (name) DO UPDATE SET color = excluded.color, icon_name = excluded.icon_name, master_id = excluded.master_id
+                    """, (name, color, icon_name, master))
+                    count += 1
+                self._notify(cur, categories=True)
+        self._categories_changed()
+        return count
+
+def create_task_manager(backend=DB_BACKEND):
+    if backend == "sqlite":
+        return SQLiteTaskManager()
+    if backend == "postgres":
+        return PostgresTaskManager()
+    raise ValueError(f"Tuntematon DB_BACKEND: {backend}")
+
+# --- ASYNC-TIETOKANTA ---
+class AsyncTaskManager:
+    # TaskManagerin metodit korutiineina Fletin async-tilaa varten. psycopg2 on
+    # synkroninen, joten kutsut ajetaan omassa säiepoolissaan, jonka koko vastaa
+    # yhteyspoolia; tapahtumasilmukka ei koskaan odota tietokantaa.
+    def __init__(self, db, max_workers=DB_POOL_MAX):
+        self.db = db
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="db")
+
+    async def run(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
+
+    def __getattr__(self, name):
+        attr = getattr(self.db, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def method(*args, **kwargs):
+            return await self.run(attr, *args, **kwargs)
+        return method
+
+# --- KIRJOITUSJONO ---
+class TaskWrite:
+    # Jonossa odottava tehtävämuutos. on_error perii muutoksen käyttöliittymästä,
+    # on_done saa tallennetun tehtävän id:n (lisäyksellä oikean id:n).
+    def __init__(self, values, on_error=None, on_done=None):
+        self.values = values
+        self.on_error = on_error
+        self.on_done = on_done
+
+class WriteBehindQueue:
+    # Tehtävien kirjoitukset kerätään jonoon ja viedään taustasäikeessä erinä yhdessä
+    # transaktiossa. Saman tehtävän peräkkäiset valinnat yhdistetään yhdeksi.
+    # Vasta lisätyt tehtävät saavat negatiivisen väliaikaisen id:n, joka korvataan
+    # oikealla, kun lisäys on tallennettu.
+    def __init__(self, db, delay=WRITE_FLUSH_DELAY, max_batch=WRITE_MAX_BATCH):
+        self.db = db
+        self.delay = delay
+        self.max_batch = max_batch
+        self._cond = threading.Condition()
+        self._flushing = threading.Lock()
+        self._thread = None
+        self._inserts = {}    # väliaikainen id -> TaskWrite
+        self._updates = {}    # id -> TaskWrite
+        self._toggles = {}    # id -> (TaskWrite, alkuperäinen tila)
+        self._deletes = {}    # id -> TaskWrite
+        self._resolved = {}   # väliaikainen id -> oikea id (kaksi viimeisintä erää)
+        self._resolved_old = {}
+        self._next_temp_id = -1
+
+    def temp_id(self):
+        with self._cond:
+            t_id = self._next_temp_id
+            self._next_temp_id -= 1
+            return t_id
+
+    def is_pending(self, task_id):
+        # Onko tehtävällä tallentamaton muutos; istunnot eivät korvaa sitä muiden muutoksilla
+        with self._cond:
+            return task_id in self._inserts or task_id in self._updates or task_id in self._toggles or task_id in self._deletes
+
+    def _pending_count(self):
+        return len(self._inserts) + len(self._updates) + len(self._toggles) + len(self._deletes)
+
+    def _wake(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="task-write-queue", daemon=True)
+            self._thread.start()
+        self._cond.notify()
+
+    def insert(self, temp_id, content, category, db_date, description, on_error=None, on_done=None):
+        with self._cond:
+            self._inserts[temp_id] = TaskWrite([content, category, db_date, description, False], on_error, on_done)
+            self._wake()
+
+    def update(self, task_id, content, category, db_date, description, on_error=None, on_done=None):
+        with self._cond:
+            pending = self._inserts.get(task_id)
+            if pending is not None:
+                pending.values[:4] = [content, category, db_date, description]
+                return
+            previous = self._updates.get(task_id)
+            if previous is not None:
+                previous.values = (content, category, db_date, description)
+            else:
+                self._updates[task_id] = TaskWrite((content, category, db_date, description), on_error, on_done)
+            self._wake()
+
+    def toggle(self, task_id, status, on_error=None, on_done=None):
+        with self._cond:
+            pending = self._inserts.get(task_id)
+            if pending is not None:
+                pending.values[4] = status
+                return
+            previous = self._toggles.get(task_id)
+            if previous is None:
+                self._toggles[task_id] = (TaskWrite(status, on_error, on_done), not status)
+            elif previous[1] == status:
+                # Valinta palasi alkuperäiseen, kirjoitettavaa ei ole
+                del self._toggles[task_id]
+            else:
+                previous[0].values = status
+            self._wake()
+
+    def delete(self, task_id, on_error=None, on_done=None):
+        with self._cond:
+            if self._inserts.pop(task_id, None) is not None:
+                return
+            self._deletes[task_id] = TaskWrite(task_id, on_error, on_done)
+            self._wake()
+
+    def _take(self):
+        with self._cond:
+            inserts = list(self._inserts.items())
+            updates = list(self._updates.items())
+            toggles = [(t_id, op) for t_id, (op, _) in self._toggles.items()]
+            deletes = list(self._deletes.items())
+            self._inserts, self._updates, self._toggles, self._deletes = {}, {}, {}, {}
+        # Lennossa olleen lisäyksen jälkeen tulleet muutokset osoitetaan oikeaan id:hen;
+        # epäonnistuneen lisäyksen muutokset pudotetaan pois
+        resolved = {**self._resolved_old, **self._resolved}
+        self._resolved_old, self._resolved = self._resolved, {}
+        resolve = lambda items: [(resolved.get(t_id, t_id), op) for t_id, op in items
+                                 if t_id > 0 or t_id in resolved]
+        return inserts, resolve(updates), resolve(toggles), resolve(deletes)
+
+    def flush(self):
+        with self._flushing:
+            inserts, updates, toggles, deletes = self._take()
+            if not (inserts or updates or toggles or deletes):
+                return
+            try:
+                self._apply(inserts, updates, toggles, deletes)
+            except Exception as e:
+                print("Virhe tehtävien tallennuksessa:", e)
+                failed = [(op, e) for _, op in inserts + updates + toggles + deletes]
+                if len(failed) > 1 and not (is_transient(e) or isinstance(e, DatabaseUnavailable)):
+                    # Yksi virheellinen muutos ei saa perua muiden kirjoituksia: yritetään
+                    # erän muutokset yksitellen, jolloin vain epäonnistunut palautetaan
+                    failed = self._apply_each(inserts, updates, toggles, deletes)
+                for op, ex in failed:
+                    if op.on_error:
+                        # Yhden palautuksen virhe ei saa estää muiden muutosten palautusta
+                        try:
+                            op.on_error(ex)
+                        except Exception as cb_error:
+                            print("Virhe tallennuksen palautuksessa:", cb_error)
+                return
+
+    def _apply(self, inserts=(), updates=(), toggles=(), deletes=()):
+        new_ids = self.db.apply_task_writes(
+            inserts=[tuple(op.values) for _, op in inserts],
+            updates=[op.values + (t_id,) for t_id, op in updates],
+            toggles=[(op.values, t_id) for t_id, op in toggles],
+            deletes=[t_id for t_id, _ in deletes],
+        )
+        done = []
+        for (temp_id, op), new_id in zip(inserts, new_ids):
+            self._resolved[temp_id] = new_id
+            done.append((op, new_id))
+        done += [(op, t_id) for t_id, op in list(updates) + list(toggles) + list(deletes)]
+        for op, t_id in done:
+            if op.on_done:
+                # Tallennus onnistui jo; käyttöliittymän virhe ei saa johtaa uusintaan
+                try:
+                    op.on_done(t_id)
+                except Exception as e:
+                    print("Virhe tallennuksen päivityksessä:", e)
+
+    def _apply_each(self, inserts, updates, toggles, deletes):
+        # Palauttaa epäonnistuneet muutokset virheineen
+        failed = []
+        for kind, items in (("inserts", inserts), ("updates", updates), ("toggles", toggles), ("deletes", deletes)):
+            for item in items:
+                try:
+                    self._apply(**{kind: [item]})
+                except Exception as e:
+                    print("Virhe tehtävän tallennuksessa:", e)
+                    failed.append((item[1], e))
+        return failed
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending_count():
+                    self._cond.wait()
+                # Odotetaan hetki, jotta nopeat peräkkäiset klikkaukset yhdistyvät
+                if self._pending_count() < self.max_batch:
+                    self._cond.wait(self.delay)
+            try:
+                self.flush()
+            except Exception as e:
+                print("Virhe kirjoitusjonossa:", e)
+
+# --- REAALIAIKAINEN SYNKRONOINTI ---
+class LiveSync:
+    # Yksi prosessia kohden: ottaa vastaan tietokannan muutosilmoitukset, hakee muuttuneet
+    # rivit kerran ja jakaa ne istunnoille Fletin pubsubilla. Istunnot soveltavat
+    # vain erotuksen omaan listaansa.
+    #   "tasks"   -> (rivit, poistetut id:t)
+    #   "refresh" -> kategoriat muuttuivat tai muutoksia on liikaa yksittäin käsiteltäviksi
+    def __init__(self, db):
+        self.db = db
+        self._clients = []
+        self._queue = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def attach(self, pubsub):
+        # Pubsub-keskus on kaikille istunnoille yhteinen, joten mikä tahansa
+        # avoimen istunnon asiakas kelpaa lähettäjäksi
+        with self._lock:
+            self._clients.append(pubsub)
+            if self._thread is None:
+                self._queue = queue.Queue()
+                self._thread = threading.Thread(target=self._run, args=(self._queue,), name="live-sync", daemon=True)
+                self._thread.start()
+                self.db.add_change_listener(self._queue.put)
+
+    def detach(self, pubsub):
+        # Viimeisen istunnon sulkeutuessa ilmoitusten käsittely pysähtyy
+        with self._lock:
+            if pubsub in self._clients:
+                self._clients.remove(pubsub)
+            if self._clients or self._thread is None:
+                return
+            self.db.remove_change_listener(self._queue.put)
+            self._queue.put(None)
+            self._queue, self._thread = None, None
+
+    def _send(self, topic, message):
+        # Suljetun tapahtumasilmukan asiakas (esim. päättynyt mittausajo) poistetaan
+        while True:
+            with self._lock:
+                if not self._clients:
+                    return
+                pubsub = self._clients[-1]
+            try:
+                pubsub.send_all_on_topic(topic, message)
+                return
+            except RuntimeError as e:
+                if "closed" not in str(e):
+                    raise
+                self.detach(pubsub)
+
+    def _take(self, changes):
+        # Ruuhkassa jonossa olevat ilmoitukset yhdistetään yhdeksi hauksi
+        change = changes.get()
+        if change is None:
+            return None
+        task_ids = set(change.get("tasks", ()))
+        refresh = bool(change.get("categories") or change.get("reload"))
+        while len(task_ids) < NOTIFY_CHUNK * 4:
+            try:
+                change = changes.get_nowait()
+            except queue.Empty:
+                break
+            if change is None:
+                changes.put(None)
+                break
+            task_ids.update(change.get("tasks", ()))
+            refresh = refresh or bool(change.get("categories") or change.get("reload"))
+        return task_ids, refresh
+
+    def _run(self, changes):
+        while True:
+            taken = self._take(changes)
+            if taken is None:
+                return
+            task_ids, refresh = taken
+            if not self._clients:
+                continue
+            try:
+                if refresh:
+                    # Päivitys hakee välilehden uudelleen, joten tehtävämuutokset sisältyvät siihen
+                    self._send("refresh", None)
+                elif task_ids:
+                    rows = self.db.get_tasks_by_ids(sorted(task_ids))
+                    removed = task_ids - {t[0] for t in rows}
+                    self._send("tasks", (rows, removed))
+            except Exception as e:
+                print("Virhe muutosten jakamisessa:", e)
+
+# --- ARKISTOINTI ---
+def archive_all(db, days=ARCHIVE_AFTER_DAYS, batch=ARCHIVE_BATCH):
+    # Siirtää erä kerrallaan; täysi erä tarkoittaa, että siirrettävää on vielä jäljellä
+    count = 0
+    while True:
+        moved = db.archive_completed(days, batch)
+        count += len(moved)
+        if len(moved) < batch:
+            return count
+
+def archive_loop(db, days, interval, batch):
+    while True:
+        try:
+            metrics.inc("diidelain_archived_tasks_total", archive_all(db, days, batch))
+        except Exception as e:
+            print("Virhe arkistoinnissa:", e)
+        time.sleep(interval)
+
+def start_archiver(db, days=ARCHIVE_AFTER_DAYS, interval=ARCHIVE_INTERVAL, batch=ARCHIVE_BATCH):
+    thread = threading.Thread(target=archive_loop, args=(db, days, interval, batch), name="archiver", daemon=True)
+    thread.start()
+    return thread
+
+# --- STAATTISET TIEDOSTOT ---
+ASSET_TYPES = {
+    ".ttf": "font/ttf",
+    ".otf": "font/otf",
+    ".woff2": "font/woff2",
+    ".png": "image/png",
+    ".svg": "image/svg+xml",
+    ".ico": "image/x-icon"
+}
+# Valmiiksi pakattavat tyypit; png ja woff2 ovat jo pakattuja
+ASSET_GZIP = (".ttf", ".otf", ".svg", ".ico")
+ASSET_CACHE_CONTROL = b"public, max-age=31536000, immutable"
+
+class StaticAssets:
+    # ASSETS_DIRin tiedostot muistissa, nimessä sisällön tiiviste: sama osoite on aina
+    # sama sisältö, joten selain saa pitää sen välimuistissa vuoden. Gzip-versio
+    # lasketaan kerran latauksessa eikä jokaisella pyynnöllä.
+    def __init__(self, directory, prefix=ASSETS_URL):
+        self.directory = directory
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._urls = None   # suhteellinen polku -> osoite
+        self._files = {}    # osoite -> (sisältö, gzip tai None, tyyppi, etag)
+
+    def _load(self):
+        urls, files = {}, {}
+        for root, dirs, names in os.walk(self.directory):
+            dirs.sort()
+            for name in sorted(names):
+                stem, ext = os.path.splitext(name)
+                ext = ext.lower()
+                if ext not in ASSET_TYPES:
+                    continue
+                path = os.path.join(root, name)
+                with open(path, "rb") as f:
+                    data = f.read()
+                digest = hashlib.sha256(data).hexdigest()[:12]
+                rel = os.path.relpath(path, self.directory).replace(os.sep, "/")
+                url = f"{self.prefix}/{rel[:len(rel) - len(name)]}{stem}.{digest}{ext}"
+                gz = gzip.compress(data, 9, mtime=0) if ext in ASSET_GZIP else None
+                if gz is not None and len(gz) >= len(data):
+                    gz = None
+                urls[rel] = url
+                files[url] = (data, gz, ASSET_TYPES[ext], f'"{digest}"'.encode())
+        self._files = files
+        self._urls = urls
+
+    def manifest(self):
+        if self._urls is None:
+            with self._lock:
+                if self._urls is None:
+                    self._load()
+        return self._urls
+
+    def url(self, rel):
+        return self.manifest().get(rel)
+
+    def preload_header(self):
+        # Fontit pyydetään heti HTML:n mukana eikä vasta kun Flutter on käynnistynyt
+        links = []
+        for url in self.manifest().values():
+            content_type = self._files[url][2]
+            if content_type.startswith("font/"):
+                links.append(f'<{url}>; rel=preload; as=font; type="{content_type}"; crossorigin')
+        return ", ".join(links).encode()
+
+    async def respond(self, scope, send):
+        self.manifest()
+        entry = self._files.get(scope["path"])
+        if entry is None or scope["method"] not in ("GET", "HEAD"):
+            await send({"type": "http.response.start", "status": 404, "headers": [(b"content-length", b"0")]})
+            await send({"type": "http.response.body", "body": b""})
+            return
+        data, gz, content_type, etag = entry
+        request = dict(scope["headers"])
+        headers = [(b"content-type", content_type.encode()), (b"cache-control", ASSET_CACHE_CONTROL),
+                   (b"etag", etag), (b"vary", b"accept-encoding")]
+        status = 200
+        if request.get(b"if-none-match") == etag:
+            status, body = 304, b""
+        elif gz is not None and b"gzip" in request.get(b"accept-encoding", b""):
+            body = gz
+            headers.append((b"content-encoding", b"gzip"))
+        else:
+            body = data
+        headers.append((b"content-length", str(len(body)).encode()))
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": b"" if scope["method"] == "HEAD" else body})
+
+class AssetMiddleware:
+    # ASGI-kuori Fletin sovelluksen ympärille: /static vastataan muistista,
+    # HTML-vastauksiin lisätään fonttien preload-otsake
+    def __init__(self, app, assets):
+        self.app = app
+        self.assets = assets
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        if scope["path"].startswith(self.assets.prefix + "/"):
+            await self.assets.respond(scope, send)
+            return
+        link = self.assets.preload_header()
+        if not link:
+            await self.app(scope, receive, send)
+            return
 
-def main(page: ft.Page):
+        async def send_with_link(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                if any(k.lower() == b"content-type" and v.startswith(b"text/html") for k, v in headers):
+                    message = dict(message, headers=headers + [(b"link", link)])
+            await send(message)
+        await self.app(scope, receive, send_with_link)
+
+def fetch_assets(directory=ASSETS_DIR, sources=FONT_SOURCES):
+    # Kertahaku esim. kontin rakennusvaiheessa; ajon aikana mitään ei haeta ulkoa
+    fetched = []
+    for rel, url in sources.items():
+        path = os.path.join(directory, rel)
+        if os.path.exists(path):
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with urllib.request.urlopen(url, timeout=30) as resp, open(path + ".tmp", "wb") as f:
+            shutil.copyfileobj(resp, f)
+        os.replace(path + ".tmp", path)
+        fetched.append(rel)
+    return fetched
+
+# --- KATEGORIAVÄLIMUISTI ---
+class CategorySnapshot:
+    # Muuttumaton kuva kategorioista hakemistoineen; istunnot lukevat tätä suoraan
+    def __init__(self, categories, masters, version):
+        self.categories = categories
+        self.masters = masters
+        self.version = version
+        self.color_by_name = {c[1]: c[2] for c in categories}
+        self.id_by_name = {c[1]: c[0] for c in categories}
+        self.name_by_id = {c[0]: c[1] for c in categories}
+        self.master_by_name = {m[1]: m for m in masters}
+        self.children_by_master = {}
+        for c in categories:
+            if c[4] is not None:
+                self.children_by_master.setdefault(c[4], []).append(c[1])
+
+class CategoryCache:
+    # Yksi välimuisti prosessia kohden, jaettu kaikkien istuntojen kesken.
+    # TaskManagerin kategoriakirjoitukset kasvattavat category_versionia,
+    # jolloin seuraava get() lataa listat uudelleen.
+    def __init__(self, db):
+        self.db = db
+        self._lock = threading.Lock()
+        self._snapshot = None
+
+    def get(self):
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.version == self.db.category_version:
+            return snapshot
+        with self._lock:
+            snapshot = self._snapshot
+            version = self.db.category_version
+            if snapshot is None or snapshot.version != version:
+                snapshot = CategorySnapshot(self.db.get_categories(), self.db.get_master_categories(), version)
+                self._snapshot = snapshot
+        return snapshot
+
+    async def get_async(self, adb):
+        # Sama kuin get(), mutta kategoriat ja pääkategoriat haetaan rinnakkain
+        snapshot = self._snapshot
+        version = self.db.category_version
+        if snapshot is not None and snapshot.version == version:
+            return snapshot
+        cats, masters = await asyncio.gather(adb.get_categories(), adb.get_master_categories())
+        snapshot = CategorySnapshot(cats, masters, version)
+        with self._lock:
+            if self._snapshot is None or self._snapshot.version <= version:
+                self._snapshot = snapshot
+        return snapshot
+
+# --- TEHTÄVÄTIETUEET ---
+# Tehdyn ja avoimen tehtävän ulkoasu: (otsikon tyyli, läpinäkyvyys, taustaväri).
+# Samat oliot jaetaan kaikkien korttien kesken.
+TASK_STYLE_OPEN = (ft.TextStyle(decoration=ft.TextDecoration.NONE, color=COLOR_TEXT, size=14, weight=ft.FontWeight.BOLD), 1.0, COLOR_CARD)
+TASK_STYLE_DONE = (ft.TextStyle(decoration=ft.TextDecoration.LINE_THROUGH, color=COLOR_TEXT, size=14, weight=ft.FontWeight.BOLD), 0.6, "#EAE0B0")
+
+class TaskRecord:
+    # Näytettävä tehtävä: näyttömuotoiset kentät lasketaan kerran, kun rivi ladataan.
+    # __slots__ pitää tietueen pienenä, koska jokaisesta ladatusta rivistä on yksi.
+    __slots__ = ("id", "content", "category", "deadline", "completed", "description", "version",
+                 "color", "meta", "style", "sort_key", "__weakref__")
+
+    def __init__(self, row, color):
+        self.id, self.content, self.category, self.deadline, completed, self.description = row[:6]
+        # Paikallisella, vielä tallentamattomalla muutoksella ei ole versiota
+        self.version = row[6] if len(row) > 6 else None
+        self.completed = bool(completed)
+        self.color = color
+        self.meta = f"{self.category} | {date_db_to_fi(self.deadline)}"
+        self.style = TASK_STYLE_DONE if self.completed else TASK_STYLE_OPEN
+        # Sama järjestys kuin get_tasks: deadline ASC (NULL viimeisenä), id ASC
+        self.sort_key = (self.deadline is None, self.deadline or date.min, self.id)
+
+    def row(self):
+        return (self.id, self.content, self.category, self.deadline, self.completed, self.description)
+
+    def replace(self, color=None, **changes):
+        # Optimistinen muutos ennen tallennusta; kategorian vaihtuessa anna myös uusi väri
+        fields = dict(zip(("id", "content", "category", "deadline", "completed", "description"), self.row()))
+        fields.update(changes)
+        return TaskRecord(tuple(fields.values()), self.color if color is None else color)
+
+class TaskRecordCache:
+    # Prosessin yhteinen välimuisti avaimella (id, rivin versio, kategoriaversio).
+    # Tietue säilyy niin kauan kuin jokin lista näyttää sitä, joten saman rivin
+    # uudelleenlataus ei muotoile mitään ja istunnot jakavat samat tietueet.
+    def __init__(self):
+        self._records = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+
+    def get(self, row, snapshot):
+        version = row[6] if len(row) > 6 else None
+        if version is None:
+            return TaskRecord(row, snapshot.color_by_name.get(row[2], COLOR_PRIMARY))
+        key = (row[0], version, snapshot.version)
+        record = self._records.get(key)
+        if record is None:
+            record = TaskRecord(row, snapshot.color_by_name.get(row[2], COLOR_PRIMARY))
+            with self._lock:
+                record = self._records.setdefault(key, record)
+        return record
+
+    def get_many(self, rows, snapshot):
+        return [self.get(row, snapshot) for row in rows]
+
+# --- TEHTÄVÄKORTIT ---
+class TaskCard:
+    # Kortin kontrollit luodaan kerran. apply() päivittää vain muuttuneet ominaisuudet,
+    # joten page.update() lähettää selaimelle pelkän erotuksen.
+    # Ilman on_toggle/on_edit/on_delete-kutsuja kortti on vain luettava (arkisto)
+    def __init__(self, task, on_toggle=None, on_edit=None, on_delete=None, on_tap=None):
+        self.task = None
+        self.selected = False
+        self.on_tap = on_tap
+
+        self.checkbox = ft.Checkbox(fill_color=COLOR_PRIMARY, disabled=on_toggle is None,
+                                    on_change=lambda e: on_toggle(self.task))
+        # expand=True sallii tekstin viedä tilaa, no_wrap=False sallii rivityksen
+        self.title = ft.Text(expand=True, no_wrap=False)
+        self.info_icon = ft.Icon(ft.Icons.INFO_OUTLINE, size=16, color=COLOR_PRIMARY)
+        self.meta = ft.Text(size=10, color=COLOR_TEXT)
+        # Kuvaus
+        self.desc_text = ft.Text(size=12, color=COLOR_DESC, visible=False, italic=True)
+
+        edit_btn = ft.IconButton(icon=ft.Icons.EDIT, icon_color=COLOR_PRIMARY, visible=on_edit is not None,
+                                 on_click=lambda e: on_edit(self.task))
+        delete_btn = ft.IconButton(icon=ft.Icons.DELETE_OUTLINE, icon_color=COLOR_DELETE, visible=on_delete is not None,
+                                   on_click=lambda e: on_delete(self.task))
+
+        # --- KORTIN SISÄLTÖ ---
+        card_content = ft.Column([
+            # Ylärivi
+            ft.Row([
+                self.checkbox,
+
+                # Keskiosa
+                ft.Container(
+                    content=ft.Column([
+                        ft.Row([self.title, self.info_icon], alignment=ft.MainAxisAlignment.START, vertical_alignment=ft.CrossAxisAlignment.START),
+                        self.meta,
+                    ], spacing=2),
+                    expand=True,
+                    on_click=self.tap
+                ),
+
+                edit_btn,
+                delete_btn
+            ], alignment=ft.MainAxisAlignment.START, vertical_alignment=ft.CrossAxisAlignment.START),
+
+            # Kuvaus
+            ft.Container(
+                content=self.desc_text,
+                padding=ft.padding.only(left=40, right=10, bottom=5)
+            )
+        ], spacing=0)
+
+        # --- PÄÄCONTAINER (Väripalkki on border_left) ---
+        self.control = ft.Container(
+            content=card_content,
+            border_radius=10,
+            padding=ft.padding.only(left=5, right=5, top=5, bottom=5),
+            shadow=ft.BoxShadow(blur_radius=2, color="#33000000"),
+            animate_size=300,
+        )
+        self.apply(task)
+
+    def apply(self, task):
+        # Välimuistin ansiosta muuttumaton rivi on sama tietue
+        old = self.task
+        if old is task:
+            return False
+        self.task = task
+
+        if old is None or old.style is not task.style:
+            self.checkbox.value = task.completed
+            self.title.style, self.control.opacity, self.control.bgcolor = task.style
+        if old is None or old.content != task.content:
+            self.title.value = task.content
+        if old is None or old.meta != task.meta:
+            self.meta.value = task.meta
+        if old is None or old.description != task.description:
+            self.desc_text.value = task.description if task.description else "Ei lisätietoja."
+            self.info_icon.visible = bool(task.description)
+        if old is None or old.color != task.color:
+            self._apply_border()
+        return True
+
+    def _apply_border(self):
+        left = ft.BorderSide(10, self.task.color)
+        if self.selected:
+            edge = ft.BorderSide(3, COLOR_PRIMARY)
+            self.control.border = ft.border.only(left=left, top=edge, right=edge, bottom=edge)
+        else:
+            self.control.border = ft.border.only(left=left)
+
+    def set_selected(self, selected):
+        if selected != self.selected:
+            self.selected = selected
+            self._apply_border()
+
+    def tap(self, e):
+        # Valintatilassa napautus valitsee kortin, muuten avaa kuvauksen
+        if self.on_tap and self.on_tap(self):
+            return
+        self.toggle_details(e)
+
+    def toggle_details(self, e):
+        self.desc_text.visible = not self.desc_text.visible
+        self.desc_text.update()
+
+class TaskList:
+    # Kortit avaimena tehtävän id: muuttumattomat kortit käytetään uudelleen ja
+    # uudet/poistuneet lisätään ja poistetaan paikallaan.
+    def __init__(self, make_card):
+        self.make_card = make_card
+        self.cards = {}
+        self.tasks = []
+        self.exhausted = True
+        self.selected = set()
+        self.control = ft.Column(spacing=10, scroll=ft.ScrollMode.AUTO)
+        self.empty = ft.Container(
+            content=ft.Text("Ei tehtäviä tässä nipussa!", color=COLOR_TEXT),
+            padding=20, alignment=ft.alignment.center
+        )
+
+    def set_tasks(self, tasks):
+        # tasks: TaskRecord-lista näyttöjärjestyksessä
+        cards = {}
+        for t in tasks:
+            card = self.cards.get(t.id)
+            if card is None:
+                card = self.make_card(t)
+            else:
+                card.apply(t)
+            card.set_selected(t.id in self.selected)
+            cards[t.id] = card
+
+        # Flet vertaa lapsilistaa kontrollien tunnisteilla, joten samoista korteista
+        # koottu lista lähtee selaimelle vain lisäyksinä ja poistoina.
+        self.control.controls = [card.control for card in cards.values()] or [self.empty]
+        self.cards = cards
+        self.tasks = list(tasks)
+
+    def show_error(self, message):
+        self.cards = {}
+        self.tasks = []
+        self.control.controls = [ft.Text(message, color="red")]
+
+    def get(self, task_id):
+        card = self.cards.get(task_id)
+        if card is not None:
+            return card.task
+        return next((t for t in self.tasks if t.id == task_id), None)
+
+    def patch(self, upserts=(), removes=()):
+        # Lisää/päivittää ja poistaa tehtäviä lajittelujärjestyksessä yhdellä uudelleenpiirrolla
+        drop = set(removes) | {t.id for t in upserts}
+        tasks = [t for t in self.tasks if t.id not in drop]
+        # Sivutetussa listassa viimeisen ladatun rivin jälkeiset tulevat seuraavalla sivulla
+        last = tasks[-1].sort_key if tasks else None
+        for task in upserts:
+            key = task.sort_key
+            if self.exhausted or (last is not None and key < last):
+                pos = next((i for i, t in enumerate(tasks) if t.sort_key > key), len(tasks))
+                tasks.insert(pos, task)
+        self.set_tasks(tasks)
+
+    def upsert(self, task):
+        self.patch(upserts=[task])
+
+    def remove(self, task_id):
+        if self.get(task_id) is not None:
+            self.patch(removes=[task_id])
+
+    def toggle_selected(self, task_id):
+        if task_id in self.selected:
+            self.selected.discard(task_id)
+        else:
+            self.selected.add(task_id)
+        card = self.cards.get(task_id)
+        if card is not None:
+            card.set_selected(task_id in self.selected)
+
+    def clear_selection(self):
+        self.selected.clear()
+        for card in self.cards.values():
+            card.set_selected(False)
+
+    def rekey(self, old_id, new_id):
+        task = self.get(old_id)
+        if task is None:
+            return
+        card = self.cards.pop(old_id, None)
+        task = task.replace(id=new_id)
+        if card is not None:
+            card.apply(task)
+            self.cards[new_id] = card
+        self.tasks = [task if t.id == old_id else t for t in self.tasks]
+
+    def page_limit(self, key=None):
+        # Ensimmäisen haun rivimäärä; sarakenäkymä hakee kaiken kerralla
+        return None
+
+    def load(self, rows, fetch, key=None, limit=None):
+        # fetch(after, limit) -> tietueet; käytetään lisäsivujen hakuun
+        self.set_tasks(rows)
+
+class VirtualTaskList(TaskList):
+    # ListView-pohjainen lista: kortit rakennetaan vain näkyvälle ikkunalle ja puskurille,
+    # muut ladatut rivit ovat kevyitä paikanpitäjiä. Lisää rivejä haetaan sivu kerrallaan
+    # get_tasks-avainjoukkosivutuksella, kun vieritys lähestyy loppua.
+    def __init__(self, make_card, item_extent=TASK_ITEM_EXTENT, estimated_extent=TASK_ITEM_ESTIMATE,
+                 page_size=TASK_PAGE_SIZE, buffer=TASK_LIST_BUFFER):
+        super().__init__(make_card)
+        self.item_extent = item_extent
+        self.extent = item_extent or estimated_extent
+        self.step = self.extent + 10
+        self.page_size = page_size
+        self.buffer = buffer
+        self.control = ft.ListView(spacing=10, item_extent=item_extent, expand=True,
+                                   on_scroll=self._on_scroll, on_scroll_interval=100)
+        self.tasks = []
+        self.placeholders = {}
+        self.fetch = None
+        self.key = None
+        self.exhausted = True
+        self.window = (0, 0)
+        self._fetching = False
+        self._lock = threading.Lock()
+
+    def page_limit(self, key=None):
+        # Päivitys samalle välilehdelle säilyttää jo ladatun määrän, uusi alkaa alusta
+        if key == self.key and self.fetch is not None:
+            return max(self.page_size, len(self.tasks))
+        return self.page_size
+
+    def load(self, rows, fetch, key=None, limit=None):
+        with self._lock:
+            if key != self.key or self.fetch is None:
+                self.window = (0, int(800 // self.step) + 1)
+                self.placeholders = {}
+            self.fetch, self.key = fetch, key
+            self.tasks = list(rows)
+            self.exhausted = limit is None or len(rows) < limit
+            self._render()
+
+    def set_tasks(self, tasks):
+        with self._lock:
+            self.tasks = list(tasks)
+            self._render()
+
+    def show_error(self, message):
+        with self._lock:
+            self.tasks, self.key, self.fetch = [], None, None
+            super().show_error(message)
+
+    def _placeholder(self, t_id):
+        ph = self.placeholders.get(t_id)
+        if ph is None:
+            ph = ft.Container(height=self.extent)
+            self.placeholders[t_id] = ph
+        return ph
+
+    def _render(self):
+        first, last = self.window
+        lo, hi = max(0, first - self.buffer), last + self.buffer
+        # Ikkunasta poistuneet kortit kierrätetään uusille riveille
+        in_window = {t.id for t in self.tasks[lo:hi]}
+        spare = [card for t_id, card in self.cards.items() if t_id not in in_window]
+        cards = {}
+        controls = []
+        for i, t in enumerate(self.tasks):
+            if lo <= i < hi:
+                card = self.cards.get(t.id)
+                if card is None and spare:
+                    card = spare.pop()
+                    card.desc_text.visible = False
+                if card is None:
+                    card = self.make_card(t)
+                else:
+                    card.apply(t)
+                card.set_selected(t.id in self.selected)
+                cards[t.id] = card
+                self.placeholders.pop(t.id, None)
+                controls.append(card.control)
+            else:
+                controls.append(self._placeholder(t.id))
+        self.cards = cards
+        self.control.controls = controls or [self.empty]
+
+    async def _fetch_more(self):
+        # Haku ajetaan tietokantasäikeessä; jos lista vaihtui välissä, sivu hylätään
+        fetch, last = self.fetch, self.tasks[-1]
+        self._fetching = True
+        try:
+            rows = await adb.run(fetch, (last.deadline, last.id), self.page_size)
+        except Exception as ex:
+            print("Virhe tehtävien haussa:", ex)
+            return False
+        finally:
+            self._fetching = False
+        with self._lock:
+            if fetch is not self.fetch or not self.tasks or self.tasks[-1] is not last:
+                return False
+            self.tasks.extend(rows)
+            self.exhausted = len(rows) < self.page_size
+            return True
+
+    async def _on_scroll(self, e):
+        if e.pixels is None or e.viewport_dimension is None:
+            return
+        first = int(e.pixels // self.step)
+        last = first + int(e.viewport_dimension // self.step) + 1
+        grew = False
+        if not self.exhausted and not self._fetching and self.tasks and last + self.buffer >= len(self.tasks):
+            grew = await self._fetch_more()
+        with self._lock:
+            if not grew and abs(first - self.window[0]) < self.buffer // 2 and last <= self.window[1]:
+                return
+            self.window = (first, last)
+            self._render()
+        self.control.update()
+
+db = create_task_manager()
+metrics.collector(lambda: [(f"diidelain_db_pool_{key}", "gauge", {}, value) for key, value in db.pool_stats().items()])
+metrics.collector(lambda: [(f"diidelain_db_breaker_{key}", "gauge", {}, value) for key, value in db.breaker.stats().items()])
+adb = AsyncTaskManager(db)
+category_cache = CategoryCache(db)
+task_records = TaskRecordCache()
+write_queue = WriteBehindQueue(db)
+atexit.register(write_queue.flush)
+live_sync = LiveSync(db)
+static_assets = StaticAssets(ASSETS_DIR)
+
+async def main(page: ft.Page):
     page.title = "Retro Taskmaster"
     page.bgcolor = COLOR_BG
     page.theme_mode = ft.ThemeMode.LIGHT
-    page.fonts = {"Retro": "https://github.com/google/fonts/raw/main/ofl/pressstart2p/PressStart2P-Regular.ttf"}
-    page.theme = ft.Theme(font_family="Retro")
+    # Puuttuva fontti ei estä käynnistystä: teema putoaa Flutterin oletusfonttiin
+    retro_font = static_assets.url(RETRO_FONT)
+    if retro_font:
+        page.fonts = {"Retro": retro_font}
+    page.theme = ft.Theme(font_family="Retro" if retro_font else None)
     page.locale = "fi-FI"
 
-    try:
-        db.create_tables()
-    except Exception as e:
-        page.add(ft.Text(f"Tietokantavirhe: {e}", color="red"))
-        return
+    metrics.inc("diidelain_sessions_total")
+    metrics.add("diidelain_active_sessions", 1)
 
+    session_open = True
+
+    def session_closed(e):
+        nonlocal session_open
+        session_open = False
+        metrics.add("diidelain_active_sessions", -1)
+        page.pubsub.unsubscribe_all()
+        live_sync.detach(page.pubsub)
+
+    page.on_close = session_closed
+
+    def update_page():
+        # Kaikki sivun päivitykset kulkevat tätä kautta, jotta sarjallistus näkyy mittareissa
+        with metrics.timer("diidelain_page_update_seconds"):
+            page.update()
+
+    categories = CategorySnapshot([], [], None)
+    # Välilehden viimeisin tulos: nimi -> (muutoslaskuri, kategoriaversio, limit, tietueet);
+    # selaimen tallenteesta piirretyllä välilehdellä muutoslaskuri on None
+    tab_cache = {}
+    current_tab = "Kaikki"
     current_categories = [] 
     current_masters = []    
     
     editing_task_id = ft.Ref[int]()
     editing_task_id.current = None
 
-    tasks_column = ft.Column(spacing=10, scroll=ft.ScrollMode.AUTO)
+    def make_card(t):
+        return TaskCard(
+            t,
+            on_toggle=lambda x: page.run_task(toggle_status, x),
+            on_edit=open_edit_dialog,
+            on_delete=lambda x: page.run_task(delete_task_click, x),
+            on_tap=select_card
+        )
+
+    # tab_list näyttää valitun välilehden, search_list hakutulokset; task_list on
+    # se näistä, joka on näkyvissä, ja korttien toiminnot kohdistuvat siihen
+    list_class = VirtualTaskList if TASK_LIST_MODE == "virtual" else TaskList
+    tab_list = list_class(make_card)
+    search_list = TaskList(make_card)
+    search_list.control.expand = True
+    task_list = tab_list
+    tasks_column = tab_list.control
     
     tabs_control = ft.Tabs(
         selected_index=0,
         animation_duration=300,
-        tabs=[ft.Tab(text="Kaikki", icon=ft.Icons.LIST)], 
+        tabs=[ft.Tab(text="Kaikki", icon=ft.Icon(ft.Icons.LIST))], 
         label_color=COLOR_BG,
         indicator_color=COLOR_BG,
         divider_color="transparent"
     )
 
-    def load_data():
-        nonlocal current_categories, current_masters
+    def set_categories(snapshot):
+        nonlocal categories, current_categories, current_masters
+        if snapshot.version != categories.version:
+            tab_cache.clear()
+        categories = snapshot
+        current_categories = snapshot.categories
+        current_masters = snapshot.masters
+
+    @timed("diidelain_ui_seconds", op="load_data")
+    async def load_data():
         try:
-            current_categories = db.get_categories()
-            current_masters = db.get_master_categories()
-        except:
-            pass
+            set_categories(await category_cache.get_async(adb))
+        except Exception as ex:
+            page.open(ft.SnackBar(ft.Text(f"Kategorioita ei voitu päivittää: {ex}"), bgcolor="red"))
 
     def get_cat_color(cat_name):
-        for c in current_categories:
-            if c[1] == cat_name:
-                return c[2]
-        return COLOR_PRIMARY
-
+        return categories.color_by_name.get(cat_name, COLOR_PRIMARY)
+
+    def to_records(rows):
+        return task_records.get_many(rows, categories)
+
+    # --- VÄLILEHTIEN LASKURIT ---
+    # Avoimet ja myöhässä olevat tehtävät kategorian nimen mukaan: nimi -> [avoimet, myöhässä].
+    # Haetaan yhdellä koostekyselyllä, omat muutokset päivitetään erotuksina.
+    task_counts = {}
+    # Tallennetut omat muutokset, jotka on jo laskettu mukaan; niiden muutosilmoitus ohitetaan
+    counted_ids = set()
+
+    def set_task_counts(counts):
+        counted_ids.clear()
+        task_counts.clear()
+        for category_id, (open_count, overdue) in counts.items():
+            name = categories.name_by_id.get(category_id)
+            task_counts[name] = [open_count, overdue]
+
+    def count_of(task):
+        if task is None or task.completed:
+            return 0, 0
+        return 1, int(task.deadline is not None and task.deadline < date.today())
+
+    def adjust_counts(old, new):
+        # old -> new on yhden tehtävän muutos; None tarkoittaa lisättyä tai poistettua
+        for task, sign in ((old, -1), (new, 1)):
+            open_count, overdue = count_of(task)
+            if open_count:
+                counts = task_counts.setdefault(task.category, [0, 0])
+                counts[0] += sign * open_count
+                counts[1] += sign * overdue
+
+    def tab_counts(tab_name):
+        if tab_name == "Kaikki":
+            names = task_counts.keys()
+        else:
+            master_cat = categories.master_by_name.get(tab_name)
+            names = categories.children_by_master.get(master_cat[0], ()) if master_cat else (tab_name,)
+        counts = [task_counts.get(name, (0, 0)) for name in names]
+        return sum(c[0] for c in counts), sum(c[1] for c in counts)
+
+    def tab_badge(tab_name):
+        if tab_name == "Myöhässä":
+            overdue = tab_counts("Kaikki")[1]
+            return ft.Badge(text=str(overdue), bgcolor=COLOR_DELETE, text_color=COLOR_BG) if overdue else None
+        if tab_name in DUE_VIEWS:
+            return None
+        open_count, overdue = tab_counts(tab_name)
+        if not open_count:
+            return None
+        if overdue:
+            return ft.Badge(text=f"{open_count} / {overdue}!", bgcolor=COLOR_DELETE, text_color=COLOR_BG)
+        return ft.Badge(text=str(open_count), bgcolor=COLOR_TEXT, text_color=COLOR_BG)
+
+    def update_badges():
+        for tab in tabs_control.tabs:
+            tab.icon.badge = tab_badge(tab.text)
+
+    def make_tab(name, icon):
+        return ft.Tab(text=name, icon=ft.Icon(icon, badge=tab_badge(name)))
+
+    @timed("diidelain_ui_seconds", op="rebuild_tabs")
     def rebuild_tabs():
         if not tabs_control.page: return
 
-        selected_text = "Kaikki"
-        if tabs_control.tabs and tabs_control.selected_index is not None and tabs_control.selected_index < len(tabs_control.tabs):
-            selected_text = tabs_control.tabs[tabs_control.selected_index].text
+        selected_text = selected_tab_text()
         
-        new_tabs = [ft.Tab(text="Kaikki", icon=ft.Icons.LIST)]
+        new_tabs = [make_tab("Kaikki", ft.Icons.LIST)]
+        new_tabs.extend(make_tab(name, icon) for name, icon in DUE_VIEWS.items())
         
         for m in current_masters:
             m_name, m_icon = m[1], m[3]
             real_icon = AVAILABLE_ICONS.get(m_icon, ft.Icons.FOLDER)
-            new_tabs.append(ft.Tab(text=m_name, icon=real_icon))
+            new_tabs.append(make_tab(m_name, real_icon))
 
         for cat in current_categories:
             c_name, c_icon_key, c_master_id = cat[1], cat[3], cat[4]
             if c_master_id is None:
                 real_icon = AVAILABLE_ICONS.get(c_icon_key, ft.Icons.CIRCLE)
-                new_tabs.append(ft.Tab(text=c_name, icon=real_icon))
+                new_tabs.append(make_tab(c_name, real_icon))
             
         tabs_control.tabs = new_tabs
         
@@ -355,123 +2923,289 @@ def main(page: ft.Page):
         tabs_control.selected_index = found_index
         tabs_control.update()
 
-    def render_tasks(tab_name="Kaikki"):
-        tasks_column.controls.clear()
-        tasks = []
-        try:
-            if tab_name == "Kaikki":
-                tasks = db.get_tasks("Kaikki")
-            else:
-                master_cat = next((m for m in current_masters if m[1] == tab_name), None)
-                if master_cat:
-                    m_id = master_cat[0]
-                    child_cats = [c[1] for c in current_categories if c[4] == m_id]
-                    if not child_cats:
-                        tasks = [] 
-                    else:
-                        tasks = db.get_tasks(sub_categories=child_cats)
-                else:
-                    tasks = db.get_tasks(category_filter=tab_name)
+    def in_current_tab(task):
+        if task_list is search_list:
+            # Hakutuloksiin ei lisätä uusia rivejä ennen uutta hakua
+            return search_list.get(task.id) is not None
+        if current_tab == "Kaikki":
+            return True
+        if current_tab in DUE_VIEWS:
+            start, end = due_range(current_tab)
+            return (not task.completed and task.deadline is not None and task.deadline < end
+                    and (start is None or task.deadline >= start))
+        master_cat = categories.master_by_name.get(current_tab)
+        if master_cat:
+            return task.category in categories.children_by_master.get(master_cat[0], ())
+        return task.category == current_tab
+
+    def tab_fetch(tab_name):
+        # Välilehden hakufunktio fetch(after, limit); ajetaan säikeessä
+        if tab_name == "Kaikki":
+            return lambda after, limit: db.get_tasks("Kaikki", after=after, limit=limit)
+        if tab_name in DUE_VIEWS:
+            start, end = due_range(tab_name)
+            return lambda after, limit: db.get_due_tasks(start, end, after=after, limit=limit)
+        master_cat = categories.master_by_name.get(tab_name)
+        if master_cat and not categories.children_by_master.get(master_cat[0]):
+            return lambda after, limit: []
+        if master_cat:
+            return lambda after, limit: db.get_tasks(master_id=master_cat[0], after=after, limit=limit)
+        category_id = categories.id_by_name.get(tab_name)
+        if category_id is not None:
+            return lambda after, limit: db.get_tasks(category_id=category_id, after=after, limit=limit)
+        return lambda after, limit: db.get_tasks(category_filter=tab_name, after=after, limit=limit)
+
+    async def fetch_tab(tab_name):
+        fetch = tab_fetch(tab_name)
+        limit = tab_list.page_limit(tab_name)
+        # Jonossa olevat omat muutokset tallennetaan ennen lukua. Muutoslaskuri luetaan
+        # ennen rivejä, jotta välissä tehty muutos mitätöi välimuistin seuraavalla kerralla.
+        # Päivämäärä kuuluu tunnisteeseen, koska päivämääränäkymät vaihtuvat keskiyöllä.
+        await adb.run(write_queue.flush)
+        token = (await adb.get_change_token(), date.today())
+        return tab_name, fetch, limit, token, await adb.run(fetch, None, limit)
+
+    def show_tasks(tab_name, fetch, limit, token, rows):
+        nonlocal loaded_at
+        # Rivit muunnetaan vasta nyt, jotta värit tulevat juuri haetusta kategoriakuvasta
+        records = to_records(rows)
+        tab_cache[tab_name] = (token, categories.version, limit, records)
+        loaded_at = datetime.now()
+        set_read_only(False)
+        show_records(tab_name, fetch, limit, records)
+        schedule_snapshot()
+
+    def show_records(tab_name, fetch, limit, records):
+        nonlocal current_tab
+        current_tab = tab_name
+        tab_list.load(records, lambda after, limit: to_records(fetch(after, limit)), key=tab_name, limit=limit)
+
+    async def cached_tab(tab_name):
+        # Palauttaa välilehden aiemman tuloksen, jos yksikään tehtävä ei ole sen jälkeen muuttunut
+        cached = tab_cache.get(tab_name)
+        if cached is None or cached[1] != categories.version:
+            return None
+        await adb.run(write_queue.flush)
+        if (await adb.get_change_token(), date.today()) != cached[0]:
+            return None
+        return cached
+
+    def selected_tab_text():
+        if tabs_control.tabs and tabs_control.selected_index is not None and tabs_control.selected_index < len(tabs_control.tabs):
+            return tabs_control.tabs[tabs_control.selected_index].text
+        return "Kaikki"
+
+    # --- LUKUTILA ---
+    # Kun kanta ei vastaa, välilehdellä näytetään sen viimeisin onnistunut haku vain
+    # luettavana ja yläreunassa ilmoitus. Kantaa kokeillaan uudelleen katkaisimen tahdissa.
+    read_only = False
+    loaded_at = None
+    read_only_text = ft.Text("", color=COLOR_TEXT, expand=True)
+    read_only_banner = ft.Container(
+        content=ft.Row([ft.Icon(ft.Icons.CLOUD_OFF, color=COLOR_DELETE), read_only_text], vertical_alignment=ft.CrossAxisAlignment.CENTER),
+        bgcolor=COLOR_CARD, border=ft.border.all(1, COLOR_DELETE), border_radius=10,
+        padding=10, margin=ft.margin.only(left=10, right=10, top=10), visible=False
+    )
 
-        except Exception as e:
-            tasks_column.controls.append(ft.Text(f"Virhe: {e}", color="red"))
-            page.update()
+    def set_read_only(active):
+        nonlocal read_only
+        was_active, read_only = read_only, active
+        if active:
+            since = f"klo {loaded_at.strftime('%H.%M')} haetut tiedot" if loaded_at else "ei tallennettuja tietoja"
+            read_only_text.value = f"Tietokantaan ei saada yhteyttä. Näytetään {since}, muutokset eivät ole mahdollisia."
+        read_only_banner.visible = active
+        tasks_column.disabled = active
+        page.floating_action_button.disabled = active
+        if active and not was_active:
+            page.run_task(retry_connection)
+
+    async def retry_connection():
+        while read_only and session_open:
+            await asyncio.sleep(max(DB_BREAKER_RESET, 1))
+            if read_only and session_open:
+                async with sync_lock:
+                    await refresh_main_view()
+
+    def show_stale(tab_name, ex):
+        # Palauttaa True, jos virhe johtui kannan tavoittamattomuudesta ja välilehdellä
+        # on aiempi tulos näytettäväksi
+        if not (is_transient(ex) or isinstance(ex, DatabaseUnavailable)):
+            return False
+        set_read_only(True)
+        cached = tab_cache.get(tab_name)
+        if cached is None:
+            return False
+        show_records(tab_name, tab_fetch(tab_name), cached[2], cached[3])
+        return True
+
+    # --- SELAIMEN TALLENNE ---
+    # Viimeksi näytetyt kategoriat, laskurit ja välilehden tehtävät tallennetaan selaimeen.
+    # Uusi istunto piirtää tallenteen heti ja tietokannan tulos korvaa sen; kortit
+    # käytetään uudelleen id:n mukaan, joten selaimelle lähtee vain erotus.
+    snapshot_pending = False
+
+    def snapshot_data():
+        tasks = [t for t in tab_list.tasks if t.id > 0][:CLIENT_SNAPSHOT_ROWS]
+        return {
+            "v": CLIENT_SNAPSHOT_VERSION,
+            "saved": datetime.now().isoformat(timespec="seconds"),
+            "tab": current_tab,
+            "categories": [list(c) for c in categories.categories],
+            "masters": [list(m) for m in categories.masters],
+            "counts": [[name, c[0], c[1]] for name, c in task_counts.items()],
+            "tasks": [[t.id, t.content, t.category, t.deadline.isoformat() if t.deadline else None, t.completed, t.description]
+                      for t in tasks]
+        }
+
+    async def save_snapshot():
+        nonlocal snapshot_pending
+        # Peräkkäiset lataukset yhdistetään yhdeksi tallennukseksi
+        await asyncio.sleep(CLIENT_SNAPSHOT_DELAY)
+        snapshot_pending = False
+        if not session_open or read_only:
             return
+        try:
+            await page.client_storage.set_async(CLIENT_SNAPSHOT_KEY, snapshot_data())
+        except Exception as e:
+            print("Virhe selaimen tallenteen tallennuksessa:", e)
 
-        if not tasks:
-            tasks_column.controls.append(ft.Container(
-                content=ft.Text("Ei tehtäviä tässä nipussa!", color=COLOR_TEXT),
-                padding=20, alignment=ft.alignment.center
-            ))
-        
-        for t in tasks:
-            t_id = t[0]
-            t_content = t[1]
-            t_cat = t[2]
-            t_deadline_db = t[3]
-            t_completed = t[4]
-            t_desc = t[5] if t[5] else ""
-            
-            display_date = date_db_to_fi(t_deadline_db)
-            cat_color = get_cat_color(t_cat)
-            decor = ft.TextDecoration.LINE_THROUGH if t_completed else ft.TextDecoration.NONE
-            opacity = 0.6 if t_completed else 1.0
-            bg_color = "#EAE0B0" if t_completed else COLOR_CARD
-
-            delete_btn = ft.IconButton(icon=ft.Icons.DELETE_OUTLINE, icon_color=COLOR_DELETE, on_click=lambda e, x=t_id: delete_task_click(x))
-            edit_btn = ft.IconButton(icon=ft.Icons.EDIT, icon_color=COLOR_PRIMARY, on_click=lambda e, x=t: open_edit_dialog(x))
+    def schedule_snapshot():
+        nonlocal snapshot_pending
+        if CLIENT_SNAPSHOT_ROWS and not snapshot_pending:
+            snapshot_pending = True
+            page.run_task(save_snapshot)
 
-            # Kuvaus
-            desc_text = ft.Text(
-                t_desc if t_desc else "Ei lisätietoja.", 
-                size=12, 
-                color=COLOR_DESC, 
-                visible=False,
-                italic=True
-            )
-            
-            info_icon = ft.Icon(ft.Icons.INFO_OUTLINE, size=16, color=COLOR_PRIMARY, visible=bool(t_desc))
-
-            # Sidotaan 'd' oikeaan elementtiin
-            def toggle_details(e, d=desc_text):
-                d.visible = not d.visible
-                page.update()
-
-            # --- KORTIN SISÄLTÖ ---
-            card_content = ft.Column([
-                # Ylärivi
-                ft.Row([
-                    ft.Checkbox(value=bool(t_completed), fill_color=COLOR_PRIMARY, on_change=lambda e, x=t_id, y=t_completed: toggle_status(x, y)),
-                    
-                    # Keskiosa
-                    ft.Container(
-                        content=ft.Column([
-                            ft.Row([
-                                # expand=True sallii tekstin viedä tilaa, no_wrap=False sallii rivityksen
-                                ft.Text(t_content, style=ft.TextStyle(decoration=decor, color=COLOR_TEXT, size=14, weight=ft.FontWeight.BOLD), expand=True, no_wrap=False), 
-                                info_icon
-                            ], alignment=ft.MainAxisAlignment.START, vertical_alignment=ft.CrossAxisAlignment.START),
-                            
-                            ft.Text(f"{t_cat} | {display_date}", size=10, color=COLOR_TEXT),
-                        ], spacing=2),
-                        expand=True,
-                        on_click=toggle_details
-                    ),
-                    
-                    edit_btn, 
-                    delete_btn
-                ], alignment=ft.MainAxisAlignment.START, vertical_alignment=ft.CrossAxisAlignment.START),
-                
-                # Kuvaus
-                ft.Container(
-                    content=desc_text, 
-                    padding=ft.padding.only(left=40, right=10, bottom=5)
-                )
-            ], spacing=0)
-
-            # --- PÄÄCONTAINER (Väripalkki on nyt border_left) ---
-            container = ft.Container(
-                content=card_content,
-                bgcolor=bg_color,
-                border_radius=10,
-                # TÄMÄ ON SE RATKAISEVA KORJAUS:
-                border=ft.border.only(left=ft.BorderSide(10, cat_color)), 
-                padding=ft.padding.only(left=5, right=5, top=5, bottom=5),
-                opacity=opacity,
-                shadow=ft.BoxShadow(blur_radius=2, color="#33000000"),
-                animate_size=300,
-            )
-            
-            tasks_column.controls.append(container)
-        page.update()
-
-    def refresh_main_view():
-        load_data()
+    @timed("diidelain_ui_seconds", op="show_snapshot")
+    async def show_snapshot():
+        nonlocal loaded_at
+        try:
+            saved = await asyncio.wait_for(page.client_storage.get_async(CLIENT_SNAPSHOT_KEY), CLIENT_SNAPSHOT_TIMEOUT)
+        except Exception:
+            return
+        # Tietokannan tulos ehti ensin tai tallenne on vanhaa muotoa
+        if categories.version is not None or tab_cache or not isinstance(saved, dict) or saved.get("v") != CLIENT_SNAPSHOT_VERSION:
+            return
+        try:
+            snapshot = CategorySnapshot([tuple(c) for c in saved["categories"]], [tuple(m) for m in saved["masters"]], None)
+            counts = {c[0]: [c[1], c[2]] for c in saved["counts"]}
+            records = [TaskRecord((r[0], r[1], r[2], date.fromisoformat(r[3]) if r[3] else None, r[4], r[5]),
+                                  snapshot.color_by_name.get(r[2], COLOR_PRIMARY)) for r in saved["tasks"]]
+            saved_at = datetime.fromisoformat(saved["saved"])
+        except (KeyError, IndexError, TypeError, ValueError):
+            return
+        set_categories(snapshot)
+        task_counts.clear()
+        task_counts.update(counts)
         rebuild_tabs()
-        current_tab_text = "Kaikki"
-        if tabs_control.tabs and tabs_control.selected_index is not None:
-             current_tab_text = tabs_control.tabs[tabs_control.selected_index].text
-        render_tasks(current_tab_text)
+        names = [t.text for t in tabs_control.tabs]
+        if saved.get("tab") in names:
+            tabs_control.selected_index = names.index(saved["tab"])
+        tab_name = selected_tab_text()
+        loaded_at = saved_at
+        # Tallenne on lukutilan varavälimuisti, jos kannan haku epäonnistuu; None-laskuri
+        # ei vastaa koskaan kannan laskuria, joten onnistunut haku korvaa sen aina
+        tab_cache[tab_name] = (None, categories.version, None, records)
+        if read_only:
+            set_read_only(True)
+        show_records(tab_name, tab_fetch(tab_name), None, records)
+        update_page()
+
+    @timed("diidelain_ui_seconds", op="render_tasks")
+    async def render_tasks(tab_name="Kaikki"):
+        try:
+            cached = await cached_tab(tab_name)
+            if cached is None:
+                show_tasks(*await fetch_tab(tab_name))
+            else:
+                show_records(tab_name, tab_fetch(tab_name), cached[2], cached[3])
+        except Exception as e:
+            if not show_stale(tab_name, e):
+                tab_list.show_error(f"Virhe: {e}")
+        update_page()
+
+    @timed("diidelain_ui_seconds", op="refresh_main_view")
+    async def refresh_main_view():
+        # Kategoriat, pääkategoriat ja tehtävät haetaan rinnakkain; välilehden
+        # tyyppi päätellään edellisestä kategoriakuvasta
+        current_tab_text = selected_tab_text()
+        snapshot, loaded, counts = await asyncio.gather(
+            category_cache.get_async(adb), fetch_tab(current_tab_text), adb.get_task_counts(), return_exceptions=True
+        )
+        if not isinstance(snapshot, Exception):
+            set_categories(snapshot)
+        if not isinstance(counts, Exception):
+            set_task_counts(counts)
+        rebuild_tabs()
+        if selected_tab_text() != current_tab_text:
+            # Valittu välilehti poistui, ladataan uusi valinta
+            await render_tasks(selected_tab_text())
+            return
+        if isinstance(loaded, Exception):
+            if not show_stale(current_tab_text, loaded):
+                tab_list.show_error(f"Virhe: {loaded}")
+        else:
+            show_tasks(*loaded)
+        update_page()
+
+    # --- REAALIAIKAISUUS ---
+    sync_lock = asyncio.Lock()
+
+    async def on_tasks_changed(topic, change):
+        rows, removed = change
+        # Ilmoitukset käsitellään saapumisjärjestyksessä
+        async with sync_lock:
+            # Omat jonossa olevat muutokset tallennetaan ja väliaikaiset id:t vaihdetaan
+            # ensin, jotta oma muutos ei palaa listaan kaksoiskappaleena
+            await adb.run(write_queue.flush)
+            shown = {t.id: t for t in task_list.tasks}
+            upserts, removes = [], []
+            # Laskurit päivitetään erotuksena, kun rivin edellinen tila on listassa;
+            # muuten lasketaan uudelleen
+            recount = False
+            # Näkyvissä olevan rivin sama versio palauttaa saman tietueen
+            for t in to_records(rows):
+                if write_queue.is_pending(t.id) or shown.get(t.id) is t:
+                    continue
+                if t.id in counted_ids:
+                    counted_ids.discard(t.id)
+                elif t.id in shown:
+                    adjust_counts(shown[t.id], t)
+                else:
+                    recount = True
+                if in_current_tab(t):
+                    upserts.append(t)
+                elif t.id in shown:
+                    removes.append(t.id)
+            for t_id in removed:
+                if write_queue.is_pending(t_id):
+                    continue
+                if t_id in counted_ids:
+                    counted_ids.discard(t_id)
+                elif t_id in shown:
+                    adjust_counts(shown[t_id], None)
+                else:
+                    recount = True
+                if t_id in shown:
+                    removes.append(t_id)
+            if recount:
+                try:
+                    set_task_counts(await adb.get_task_counts())
+                except Exception as e:
+                    print("Virhe laskureiden haussa:", e)
+            if not (upserts or removes or recount):
+                return
+            update_badges()
+            if upserts or removes:
+                task_list.patch(upserts, removes)
+            update_page()
+
+    async def on_refresh(topic, message):
+        async with sync_lock:
+            await refresh_main_view()
+
+    page.pubsub.subscribe_topic("tasks", on_tasks_changed)
+    page.pubsub.subscribe_topic("refresh", on_refresh)
+    live_sync.attach(page.pubsub)
 
     # --- TASK DIALOG ---
     new_task_name = ft.TextField(label="Tehtävä", border_color=COLOR_PRIMARY, color=COLOR_TEXT, expand=True)
@@ -492,7 +3226,7 @@ def main(page: ft.Page):
         ], height=300, width=320),
         actions=[
             ft.TextButton(content=ft.Text("Peruuta", color=COLOR_TEXT), on_click=lambda e: page.close(add_dialog)),
-            ft.ElevatedButton(content=ft.Text("Tallenna", color=COLOR_BG), bgcolor=COLOR_PRIMARY, on_click=lambda e: save_task(e))
+            ft.ElevatedButton(content=ft.Text("Tallenna", color=COLOR_BG), bgcolor=COLOR_PRIMARY, on_click=lambda e: page.run_task(save_task, e))
         ]
     )
 
@@ -539,7 +3273,7 @@ def main(page: ft.Page):
                 cat_edit_name,
                 ft.Row([cat_edit_color, cat_edit_icon, cat_icon_preview], alignment=ft.MainAxisAlignment.SPACE_BETWEEN),
                 cat_edit_master,
-                ft.ElevatedButton(content=ft.Text("Tallenna Kategoria", color=COLOR_BG), bgcolor=COLOR_PRIMARY, on_click=lambda e: save_category(e)),
+                ft.ElevatedButton(content=ft.Text("Tallenna Kategoria", color=COLOR_BG), bgcolor=COLOR_PRIMARY, on_click=lambda e: page.run_task(save_category, e)),
                 ft.Divider(),
                 categories_list_view
             ]),
@@ -550,7 +3284,7 @@ def main(page: ft.Page):
                 ft.Text("Lisää/Muokkaa Nippua:", size=12, color=COLOR_TEXT),
                 master_edit_name,
                 ft.Row([master_edit_icon, master_icon_preview], alignment=ft.MainAxisAlignment.SPACE_BETWEEN),
-                ft.ElevatedButton(content=ft.Text("Tallenna Nippu", color=COLOR_BG), bgcolor=COLOR_PRIMARY, on_click=lambda e: save_master(e)),
+                ft.ElevatedButton(content=ft.Text("Tallenna Nippu", color=COLOR_BG), bgcolor=COLOR_PRIMARY, on_click=lambda e: page.run_task(save_master, e)),
                 ft.Divider(),
                 masters_list_view
             ]),
@@ -570,37 +3304,92 @@ def main(page: ft.Page):
         title=ft.Text("Asetukset", color=COLOR_TEXT),
         bgcolor=COLOR_BG,
         content=settings_content,
-        actions=[ft.TextButton(content=ft.Text("Sulje", color=COLOR_TEXT), on_click=lambda e: close_settings(e))]
+        actions=[ft.TextButton(content=ft.Text("Sulje", color=COLOR_TEXT), on_click=lambda e: page.run_task(close_settings, e))]
     )
 
     # --- TOIMINNOT ---
 
-    def save_task(e):
-        if not new_task_name.value: return
-        try:
-            if editing_task_id.current:
-                db.update_task(editing_task_id.current, new_task_name.value, new_task_cat_dropdown.value, date_input.value, new_task_desc.value)
-                msg = "Päivitetty!"
-            else:
-                db.add_task(new_task_name.value, new_task_cat_dropdown.value, date_input.value, new_task_desc.value)
-                msg = "Luotu!"
-            page.close(add_dialog)
-            refresh_main_view()
-            page.open(ft.SnackBar(ft.Text(msg, color=COLOR_BG), bgcolor=COLOR_TEXT))
-        except Exception as ex:
-            print(ex)
-
-    def delete_task_click(t_id):
+    async def notify_write_failed(previous, ex, remove_id=None):
+        # Kirjoitusjono ajaa tämän istunnon silmukassa, jos erä epäonnistui
+        if remove_id is not None:
+            task_list.remove(remove_id)
+        if previous is not None and in_current_tab(previous):
+            task_list.upsert(previous)
+        # Optimistiset laskurimuutokset eivät enää pidä paikkaansa
         try:
-            db.delete_task(t_id)
-            refresh_main_view()
-        except: pass
-
-    def toggle_status(t_id, current):
-        try:
-            db.toggle_task(t_id, current)
-            refresh_main_view()
-        except: pass
+            set_task_counts(await adb.get_task_counts())
+            update_badges()
+        except Exception as count_ex:
+            print("Virhe laskureiden haussa:", count_ex)
+        page.open(ft.SnackBar(ft.Text(f"Tallennus epäonnistui: {ex}"), bgcolor="red"))
+        update_page()
+
+    async def write_applied(task_id, shown_list=None, temp_id=None):
+        # Kirjoitusjono ajaa tämän vasta tallennuksen jälkeen, joten jonossa yhdistetty
+        # tai peruttu muutos ei jää odottamaan ilmoitusta, jota ei koskaan tule
+        counted_ids.add(task_id)
+        if shown_list is not None:
+            shown_list.rekey(temp_id, task_id)
+
+    async def save_task(e):
+        if not new_task_name.value: return
+        content, category, description = new_task_name.value, new_task_cat_dropdown.value, new_task_desc.value
+        # Virheellinen päivä hylätään jo tässä, ettei se kaada koko kirjoituserää
+        deadline = date_fi_to_date(date_input.value)
+        if deadline is None:
+            page.open(ft.SnackBar(ft.Text(f"Virheellinen päivämäärä: {date_input.value}"), bgcolor="red"))
+            update_page()
+            return
+        db_date = deadline.isoformat()
+        if editing_task_id.current:
+            t_id = editing_task_id.current
+            previous = task_list.get(t_id)
+            completed = previous.completed if previous else False
+            task = TaskRecord((t_id, content, category, deadline, completed, description), get_cat_color(category))
+            write_queue.update(t_id, content, category, db_date, description,
+                               on_error=lambda ex: page.run_task(notify_write_failed, previous, ex, remove_id=t_id),
+                               on_done=lambda saved_id: page.run_task(write_applied, saved_id))
+            adjust_counts(previous, task)
+            msg = "Päivitetty!"
+        else:
+            t_id = write_queue.temp_id()
+            task = TaskRecord((t_id, content, category, deadline, False, description), get_cat_color(category))
+            shown_list = task_list
+            write_queue.insert(t_id, content, category, db_date, description,
+                               on_error=lambda ex: page.run_task(notify_write_failed, None, ex, remove_id=t_id),
+                               on_done=lambda new_id: page.run_task(write_applied, new_id, shown_list, t_id))
+            adjust_counts(None, task)
+            msg = "Luotu!"
+        if in_current_tab(task):
+            task_list.upsert(task)
+        else:
+            task_list.remove(t_id)
+        update_badges()
+        page.close(add_dialog)
+        page.open(ft.SnackBar(ft.Text(msg, color=COLOR_BG), bgcolor=COLOR_TEXT))
+        update_page()
+
+    async def delete_task_click(task):
+        task_list.remove(task.id)
+        adjust_counts(task, None)
+        update_badges()
+        update_page()
+        write_queue.delete(task.id, on_error=lambda ex: page.run_task(notify_write_failed, task, ex),
+                           on_done=lambda saved_id: page.run_task(write_applied, saved_id))
+
+    async def toggle_status(task):
+        new_status = not task.completed
+        toggled = task.replace(completed=new_status)
+        # Päivämääränäkymät näyttävät vain avoimet tehtävät
+        if in_current_tab(toggled):
+            task_list.upsert(toggled)
+        else:
+            task_list.remove(task.id)
+        adjust_counts(task, toggled)
+        update_badges()
+        update_page()
+        write_queue.toggle(task.id, new_status, on_error=lambda ex: page.run_task(notify_write_failed, task, ex),
+                           on_done=lambda saved_id: page.run_task(write_applied, saved_id))
 
     def open_new_dialog(e):
         editing_task_id.current = None
@@ -614,14 +3403,14 @@ def main(page: ft.Page):
         page.open(add_dialog)
 
     def open_edit_dialog(t):
-        editing_task_id.current = t[0]
-        new_task_name.value = t[1]
-        new_task_desc.value = t[5] if t[5] else "" 
+        editing_task_id.current = t.id
+        new_task_name.value = t.content
+        new_task_desc.value = t.description if t.description else "" 
         
         opts = [ft.dropdown.Option(c[1]) for c in current_categories]
         new_task_cat_dropdown.options = opts
-        new_task_cat_dropdown.value = t[2]
-        date_input.value = date_db_to_fi(t[3])
+        new_task_cat_dropdown.value = t.category
+        date_input.value = date_db_to_fi(t.deadline)
         add_dialog.title = ft.Text("Muokkaa", color=COLOR_TEXT)
         page.open(add_dialog)
 
@@ -633,7 +3422,7 @@ def main(page: ft.Page):
                 content=ft.Row([
                     ft.Container(width=15, height=15, bgcolor=c_color, border_radius=5),
                     ft.Text(c_name, color=COLOR_TEXT, expand=True),
-                    ft.IconButton(icon=ft.Icons.DELETE, icon_color=COLOR_DELETE, on_click=lambda e, x=c_name: delete_category(x))
+                    ft.IconButton(icon=ft.Icons.DELETE, icon_color=COLOR_DELETE, on_click=lambda e, x=c_name: page.run_task(delete_category, x))
                 ]),
                 bgcolor="#FFFFFF", padding=5, border_radius=5,
                 on_click=lambda e, x=c: prefill_cat_form(x)
@@ -647,7 +3436,7 @@ def main(page: ft.Page):
                 content=ft.Row([
                     ft.Icon(AVAILABLE_ICONS.get(m_icon, ft.Icons.FOLDER), color=COLOR_PRIMARY),
                     ft.Text(m_name, color=COLOR_TEXT, expand=True),
-                    ft.IconButton(icon=ft.Icons.DELETE, icon_color=COLOR_DELETE, on_click=lambda e, x=m_id: delete_master(x))
+                    ft.IconButton(icon=ft.Icons.DELETE, icon_color=COLOR_DELETE, on_click=lambda e, x=m_id: page.run_task(delete_master, x))
                 ]),
                 bgcolor="#FFFFFF", padding=5, border_radius=5,
                 on_click=lambda e, x=m: prefill_master_form(x)
@@ -681,7 +3470,7 @@ def main(page: ft.Page):
         master_icon_preview.name = AVAILABLE_ICONS.get(master_data[3], ft.Icons.FOLDER)
         settings_dialog.update()
 
-    def save_category(e):
+    async def save_category(e):
         if not cat_edit_name.value: return
         real_color = AVAILABLE_COLORS.get(cat_edit_color.value, COLOR_PRIMARY)
         icon_name = cat_edit_icon.value or "Muu"
@@ -690,64 +3479,258 @@ def main(page: ft.Page):
 
         try:
             if hasattr(cat_edit_name, 'data') and cat_edit_name.data:
-                db.update_category(cat_edit_name.data, cat_edit_name.value, real_color, icon_name, real_master_id)
+                await adb.update_category(cat_edit_name.data, cat_edit_name.value, real_color, icon_name, real_master_id)
                 cat_edit_name.data = None
             else:
-                db.add_category(cat_edit_name.value, real_color, icon_name, real_master_id)
+                await adb.add_category(cat_edit_name.value, real_color, icon_name, real_master_id)
             
             cat_edit_name.value = ""
-            load_data()
+            await load_data()
             render_settings_lists()
             page.open(ft.SnackBar(ft.Text("Kategoria tallennettu", color=COLOR_BG), bgcolor=COLOR_TEXT))
         except Exception as ex:
             page.open(ft.SnackBar(ft.Text(f"Virhe: {ex}"), bgcolor="red"))
 
-    def save_master(e):
+    async def save_master(e):
         if not master_edit_name.value: return
         icon_name = master_edit_icon.value or "Kansio"
         try:
             if hasattr(master_edit_name, 'data') and master_edit_name.data:
-                db.update_master_category(master_edit_name.data, master_edit_name.value, "None", icon_name)
+                await adb.update_master_category(master_edit_name.data, master_edit_name.value, "None", icon_name)
                 master_edit_name.data = None
             else:
-                db.add_master_category(master_edit_name.value, "None", icon_name)
+                await adb.add_master_category(master_edit_name.value, "None", icon_name)
             
             master_edit_name.value = ""
-            load_data()
+            await load_data()
             render_settings_lists()
             update_master_dropdown()
             page.open(ft.SnackBar(ft.Text("Nippu tallennettu", color=COLOR_BG), bgcolor=COLOR_TEXT))
         except Exception as ex:
             page.open(ft.SnackBar(ft.Text(f"Virhe: {ex}"), bgcolor="red"))
 
-    def delete_category(name):
+    async def delete_category(name):
         if name == "Muu": return
         try:
-            db.delete_category(name)
-            load_data()
+            await adb.delete_category(name)
+            await load_data()
             render_settings_lists()
-        except: pass
+        except Exception as ex:
+            page.open(ft.SnackBar(ft.Text(f"Virhe: {ex}"), bgcolor="red"))
 
-    def delete_master(m_id):
+    async def delete_master(m_id):
         try:
-            db.delete_master_category(m_id)
-            load_data()
+            await adb.delete_master_category(m_id)
+            await load_data()
             render_settings_lists()
             update_master_dropdown()
-        except: pass
+        except Exception as ex:
+            page.open(ft.SnackBar(ft.Text(f"Virhe: {ex}"), bgcolor="red"))
 
-    def open_settings(e):
-        load_data()
+    async def open_settings(e):
+        await load_data()
         render_settings_lists()
         update_master_dropdown()
         page.open(settings_dialog)
 
-    def close_settings(e):
+    async def close_settings(e):
         page.close(settings_dialog)
-        refresh_main_view()
+        await refresh_main_view()
+
+    async def tab_changed(e):
+        await render_tasks(e.control.tabs[e.control.selected_index].text)
+
+    # --- HAKU ---
+    search_query = ""
+    search_job = None
+    search_info = ft.Text("", color=COLOR_TEXT, size=12)
+    more_results = ft.TextButton(content=ft.Text("Lisää tuloksia", color=COLOR_PRIMARY), visible=False,
+                                 on_click=lambda e: page.run_task(load_more_results, e))
+    search_view = ft.Container(
+        content=ft.Column([search_info, search_list.control, more_results], expand=True),
+        padding=10, expand=True, visible=False
+    )
+
+    def show_search(active):
+        nonlocal task_list
+        task_list.clear_selection()
+        task_list = search_list if active else tab_list
+        tabs_container.visible = list_container.visible = not active
+        search_view.visible = active
+        update_bulk_bar()
+
+    async def run_search(query):
+        nonlocal search_query
+        # Odotetaan kirjoittamisen taukoa; uusi merkki peruu edellisen haun
+        await asyncio.sleep(SEARCH_DEBOUNCE)
+        query = query.strip()
+        if not search_terms(query):
+            if search_query:
+                search_query = ""
+                show_search(False)
+                await refresh_main_view()
+            return
+        try:
+            await adb.run(write_queue.flush)
+            rows = await adb.search_tasks(query, limit=TASK_PAGE_SIZE)
+        except Exception as e:
+            search_list.show_error(f"Virhe: {e}")
+            rows = []
+        else:
+            search_list.set_tasks(to_records(rows))
+        search_query = query
+        search_info.value = f"Hakutulokset: {query}" if rows else f"Ei osumia haulle: {query}"
+        more_results.visible = len(rows) == TASK_PAGE_SIZE
+        if task_list is not search_list:
+            show_search(True)
+        update_page()
+
+    async def search_changed(e):
+        nonlocal search_job
+        if search_job is not None:
+            search_job.cancel()
+        search_job = asyncio.create_task(run_search(e.control.value or ""))
+
+    async def load_more_results(e):
+        try:
+            rows = await adb.search_tasks(search_query, limit=TASK_PAGE_SIZE, offset=len(search_list.tasks))
+        except Exception as ex:
+            page.open(ft.SnackBar(ft.Text(f"Virhe: {ex}"), bgcolor="red"))
+            update_page()
+            return
+        search_list.set_tasks(search_list.tasks + [t for t in to_records(rows) if search_list.get(t.id) is None])
+        more_results.visible = len(rows) == TASK_PAGE_SIZE
+        update_page()
+
+    search_field = ft.TextField(
+        hint_text="Hae tehtäviä", prefix_icon=ft.Icons.SEARCH, border_color=COLOR_PRIMARY,
+        color=COLOR_TEXT, dense=True, on_change=search_changed
+    )
+
+    # --- ARKISTO ---
+    # Arkistoidut tehtävät haetaan vasta näkymää avattaessa, sivu kerrallaan uusimmasta alkaen
+    archive_list = TaskList(lambda t: TaskCard(t))
+    archive_list.control.expand = True
+    archive_after = None
+    archive_info = ft.Text("", color=COLOR_TEXT, size=12)
+    archive_more = ft.TextButton(content=ft.Text("Lisää vanhempia", color=COLOR_PRIMARY), visible=False,
+                                 on_click=lambda e: page.run_task(load_archive_page))
+    archive_view = ft.Container(
+        content=ft.Column([archive_info, archive_list.control, archive_more], expand=True),
+        padding=10, expand=True, visible=False
+    )
 
-    def tab_changed(e):
-        render_tasks(e.control.tabs[e.control.selected_index].text)
+    async def load_archive_page():
+        nonlocal archive_after
+        try:
+            rows = await adb.get_archived_tasks(after=archive_after, limit=TASK_PAGE_SIZE)
+        except Exception as ex:
+            page.open(ft.SnackBar(ft.Text(f"Virhe: {ex}"), bgcolor="red"))
+            update_page()
+            return
+        if rows:
+            archive_after = (rows[-1][7], rows[-1][0])
+        archive_list.set_tasks(archive_list.tasks + to_records(rows))
+        archive_info.value = "Arkistoidut tehtävät" if archive_list.tasks else "Arkisto on tyhjä."
+        archive_more.visible = len(rows) == TASK_PAGE_SIZE
+        update_page()
+
+    async def toggle_archive(e):
+        nonlocal archive_after
+        active = not archive_view.visible
+        archive_view.visible = active
+        main_view.visible = not active
+        # Suljettaessa ladatut sivut vapautetaan
+        archive_after = None
+        archive_list.set_tasks([])
+        if active:
+            await load_archive_page()
+        else:
+            update_page()
+
+    # --- MONIVALINTA ---
+    selection_mode = False
+    bulk_count = ft.Text("", color=COLOR_TEXT, size=12)
+    bulk_category = ft.Dropdown(label="Siirrä", border_color=COLOR_PRIMARY, color=COLOR_TEXT, width=160)
+
+    def update_bulk_bar():
+        bulk_count.value = f"{len(task_list.selected)} valittu"
+        bulk_bar.visible = selection_mode
+
+    async def toggle_selection_mode(e):
+        nonlocal selection_mode
+        selection_mode = not selection_mode
+        task_list.clear_selection()
+        bulk_category.options = [ft.dropdown.Option(c[1]) for c in current_categories]
+        update_bulk_bar()
+        update_page()
+
+    def select_card(card):
+        # Kortti tarvitsee vastauksen heti; valinta itse tehdään istunnon silmukassa
+        if not selection_mode:
+            return False
+        page.run_task(toggle_card_selected, card.task.id)
+        return True
+
+    async def toggle_card_selected(task_id):
+        task_list.toggle_selected(task_id)
+        update_bulk_bar()
+        update_page()
+
+    async def bulk_apply(action, *args, patch=None):
+        # Joukkotoiminto yhtenä SQL-lauseena ja yhtenä uudelleenpiirtona
+        ids = [t_id for t_id in task_list.selected if t_id > 0]
+        if not ids:
+            return
+        try:
+            await adb.run(write_queue.flush)
+            await action(ids, *args)
+        except Exception as ex:
+            page.open(ft.SnackBar(ft.Text(f"Virhe: {ex}"), bgcolor="red"))
+            update_page()
+            return
+        selected = [t for t in (task_list.get(t_id) for t_id in ids) if t is not None]
+        task_list.clear_selection()
+        if patch:
+            changed = [patch(t) for t in selected]
+            task_list.patch(upserts=[t for t in changed if in_current_tab(t)],
+                            removes=[t.id for t in changed if not in_current_tab(t)])
+        else:
+            changed = [None] * len(selected)
+            task_list.patch(removes=ids)
+        for old, new in zip(selected, changed):
+            adjust_counts(old, new)
+            counted_ids.add(old.id)
+        update_badges()
+        update_bulk_bar()
+        update_page()
+
+    async def bulk_complete(e):
+        await bulk_apply(adb.toggle_tasks, True, patch=lambda t: t.replace(completed=True))
+
+    async def bulk_reopen(e):
+        await bulk_apply(adb.toggle_tasks, False, patch=lambda t: t.replace(completed=False))
+
+    async def bulk_move(e):
+        if not bulk_category.value: return
+        category = bulk_category.value
+        await bulk_apply(adb.move_tasks, category, patch=lambda t: t.replace(category=category, color=get_cat_color(category)))
+
+    async def bulk_delete(e):
+        await bulk_apply(adb.delete_tasks)
+
+    bulk_bar = ft.Container(
+        content=ft.Row([
+            bulk_count,
+            ft.IconButton(icon=ft.Icons.DONE_ALL, icon_color=COLOR_PRIMARY, tooltip="Merkitse tehdyiksi", on_click=bulk_complete),
+            ft.IconButton(icon=ft.Icons.REMOVE_DONE, icon_color=COLOR_PRIMARY, tooltip="Merkitse avoimiksi", on_click=bulk_reopen),
+            bulk_category,
+            ft.IconButton(icon=ft.Icons.DRIVE_FILE_MOVE, icon_color=COLOR_PRIMARY, tooltip="Siirrä kategoriaan", on_click=bulk_move),
+            ft.IconButton(icon=ft.Icons.DELETE, icon_color=COLOR_DELETE, tooltip="Poista", on_click=bulk_delete),
+            ft.IconButton(icon=ft.Icons.CLOSE, icon_color=COLOR_TEXT, tooltip="Lopeta valinta", on_click=toggle_selection_mode),
+        ], wrap=True, vertical_alignment=ft.CrossAxisAlignment.CENTER),
+        bgcolor=COLOR_CARD, padding=10, border_radius=10, visible=False
+    )
 
     tabs_control.on_change = tab_changed
 
@@ -755,7 +3738,11 @@ def main(page: ft.Page):
         title=ft.Text("DIIDELAINIT", color=COLOR_BG, font_family="Retro"), 
         center_title=True, 
         bgcolor=COLOR_PRIMARY,
-        actions=[ft.IconButton(icon=ft.Icons.SETTINGS, icon_color=COLOR_BG, on_click=open_settings)]
+        actions=[
+            ft.IconButton(icon=ft.Icons.ARCHIVE, icon_color=COLOR_BG, tooltip="Arkisto", on_click=toggle_archive),
+            ft.IconButton(icon=ft.Icons.CHECKLIST, icon_color=COLOR_BG, tooltip="Valitse useita", on_click=toggle_selection_mode),
+            ft.IconButton(icon=ft.Icons.SETTINGS, icon_color=COLOR_BG, on_click=open_settings)
+        ]
     )
     
     page.floating_action_button = ft.FloatingActionButton(
@@ -765,14 +3752,167 @@ def main(page: ft.Page):
         on_click=open_new_dialog
     )
 
-    page.add(
-        ft.Column([
-            ft.Container(content=tabs_control, bgcolor=COLOR_PRIMARY),
-            ft.Container(content=tasks_column, padding=10, expand=True)
-        ], expand=True)
-    )
+    tabs_container = ft.Container(content=tabs_control, bgcolor=COLOR_PRIMARY)
+    list_container = ft.Container(content=tasks_column, padding=10, expand=True)
+
+    main_view = ft.Column([
+        read_only_banner,
+        ft.Container(content=search_field, padding=ft.padding.only(left=10, right=10, top=10)),
+        tabs_container,
+        list_container,
+        search_view,
+        bulk_bar
+    ], expand=True)
+
+    page.add(ft.Column([main_view, archive_view], expand=True))
+
+    # Tietokantahaku alkaa heti; selaimen tallenne piirretään sillä välin, jos se ehtii ensin
+    if CLIENT_SNAPSHOT_ROWS:
+        page.run_task(show_snapshot)
+    await refresh_main_view()
+
+# --- TYÖPROSESSIT ---
+def worker_pool_size(workers=WEB_WORKERS, budget=DB_POOL_BUDGET):
+    # Budjettiin lasketaan jokaisen prosessin LISTEN-yhteys ja pääprosessin arkistointiyhteys
+    if not budget:
+        return DB_POOL_MAX
+    size = (budget - 1) // workers - 1
+    if size < 1:
+        raise ValueError(f"DB_POOL_BUDGET={budget} ei riitä {workers} työprosessille (vähintään {2 * workers + 1})")
+    return size
+
+def worker_count(workers=WEB_WORKERS, budget=DB_POOL_BUDGET):
+    # Jokainen prosessi tarvitsee vähintään yhden poolin yhteyden ja LISTEN-yhteyden;
+    # liian pieni budjetti vähentää prosesseja eikä ylitä rajaa
+    if not budget:
+        return workers
+    fits = (budget - 1) // 2
+    if fits < 1:
+        raise ValueError(f"DB_POOL_BUDGET={budget} ei riitä yhdellekään työprosessille (vähintään 3)")
+    if fits < workers:
+        print(f"DB_POOL_BUDGET={budget} riittää {fits} työprosessille, WEB_WORKERS={workers} pienennetään")
+    return min(workers, fits)
+
+def web_app():
+    # Fletin FastAPI-sovellus: omat tiedostot vastataan ennen Fletiä, muu pakataan lennossa
+    import flet.fastapi as flet_fastapi
+    from starlette.middleware.gzip import GZipMiddleware
+    app = flet_fastapi.app(main, assets_dir=ASSETS_DIR, web_renderer=ft.WebRenderer.CANVAS_KIT)
+    return AssetMiddleware(GZipMiddleware(app, minimum_size=1024, compresslevel=6), static_assets)
+
+def serve_web(port=None, sockets=None):
+    import uvicorn
+    config = uvicorn.Config(web_app(), host="0.0.0.0", port=port or 8080, log_level="warning")
+    uvicorn.Server(config).run(sockets=sockets)
+
+def run_worker(index, sock):
+    # Lapsiprosessi tuo moduulin uudelleen, joten sillä on oma pooli, välimuistit ja LiveSync.
+    # Istunto elää sen websocketin varassa, jonka ydin ohjasi tälle prosessille; muiden
+    # prosessien kirjoitukset tulevat Postgresin NOTIFYlla kuten muiltakin koneilta.
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT + 1 + index)
+    serve_web(sockets=[sock])
+
+def serve_workers(port, workers=WEB_WORKERS):
+    # Pääprosessi avaa portin ja jakaa sen työprosesseille; kuollut prosessi käynnistetään uudelleen
+    os.environ["DB_POOL_MAX"] = str(worker_pool_size(workers))
+    sock = socket.create_server(("0.0.0.0", port), backlog=2048)
+    ctx = multiprocessing.get_context("spawn")
+    procs = {}
+
+    def start(index):
+        proc = ctx.Process(target=run_worker, args=(index, sock), name=f"web-{index}")
+        proc.start()
+        procs[index] = proc
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for index in range(workers):
+            start(index)
+        print(f"{workers} työprosessia portissa {port}, yhteyksiä enintään {os.environ['DB_POOL_MAX']} per prosessi")
+        while True:
+            time.sleep(1)
+            for index, proc in list(procs.items()):
+                if not proc.is_alive():
+                    print(f"Työprosessi {index} pysähtyi (koodi {proc.exitcode}), käynnistetään uudelleen")
+                    start(index)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for proc in procs.values():
+            proc.terminate()
+        for proc in procs.values():
+            proc.join()
+        sock.close()
+
+def serve():
+    port = int(os.environ.get("PORT", 8080))
+    # Skeema päivitetään kerran prosessin käynnistyessä, ei istuntojen alussa
+    try:
+        db.migrate()
+    except Exception as e:
+        print("Virhe tietokannan päivityksessä:", e)
+    if METRICS_PORT:
+        start_metrics_server()
+    if ARCHIVE_AFTER_DAYS:
+        start_archiver(db)
+    if not static_assets.url(RETRO_FONT):
+        print(f"Retro-fonttia ei löydy ({os.path.join(ASSETS_DIR, RETRO_FONT)}), käytetään oletusfonttia. "
+              "Hae se kerran komennolla: python app.py assets --fetch")
+    if WEB_WORKERS > 1 and db.dialect == "postgres":
+        serve_workers(port, worker_count())
+        return
+    if WEB_WORKERS > 1:
+        print("WEB_WORKERS ohitetaan: SQLite-kantaa käyttää vain yksi prosessi")
+    serve_web(port)
+
+def cli(argv):
+    parser = argparse.ArgumentParser(description="Retro Taskmaster")
+    sub = parser.add_subparsers(dest="command")
+    sub.add_parser("serve", help="käynnistä sovellus (oletus)")
+    p = sub.add_parser("archive", help="siirrä vanhat tehdyt tehtävät arkistoon")
+    p.add_argument("--days", type=int, default=ARCHIVE_AFTER_DAYS or 30, help="tehty yli näin monta päivää sitten")
+    p = sub.add_parser("assets", help="listaa omat staattiset tiedostot osoitteineen")
+    p.add_argument("--fetch", action="store_true", help="hae puuttuvat fontit alkuperäisistä lähteistä")
+    for name, help_text in (("export", "vie tehtävät tai kategoriat"), ("import", "tuo tehtävät tai kategoriat")):
+        p = sub.add_parser(name, help=help_text)
+        p.add_argument("table", choices=("tasks", "categories"))
+        p.add_argument("file", nargs="?", default="-", help="tiedosto, oletuksena stdin/stdout")
+        p.add_argument("--format", choices=COPY_FORMATS, help="oletus päätellään tiedostopäätteestä")
+    args = parser.parse_args(argv)
+
+    if args.command in (None, "serve"):
+        serve()
+        return
+
+    if args.command == "assets":
+        if args.fetch:
+            for rel in fetch_assets():
+                print(f"Haettu {rel}", file=sys.stderr)
+        for rel, url in StaticAssets(ASSETS_DIR).manifest().items():
+            print(f"{rel}\t{url}")
+        return
+
+    if args.command == "archive":
+        db.migrate()
+        print(f"Arkistoitu {archive_all(db, args.days)} tehtävää", file=sys.stderr)
+        return
 
-    refresh_main_view()
+    fmt = args.format or ("ndjson" if args.file.endswith((".ndjson", ".jsonl")) else "csv")
+    if args.command == "export":
+        out = sys.stdout if args.file == "-" else open(args.file, "w", encoding="utf-8", newline="")
+        try:
+            getattr(db, f"export_{args.table}")(out, fmt)
+        finally:
+            if out is not sys.stdout: out.close()
+    else:
+        db.migrate()
+        src = sys.stdin if args.file == "-" else open(args.file, encoding="utf-8", newline="")
+        try:
+            count = getattr(db, f"import_{args.table}")(src, fmt)
+        finally:
+            if src is not sys.stdin: src.close()
+        print(f"Tuotu {count} riviä", file=sys.stderr)
 
-port = int(os.environ.get("PORT", 8080))
-ft.app(target=main, view=ft.AppView.WEB_BROWSER, port=port, host="0.0.0.0")
+if __name__ == "__main__":
+    cli(sys.argv[1:])
@@ -0,0 +1,524 @@
+# Suorituskykymittaukset: TaskManagerin kyselyt, korttien rakentaminen ja
+# koko istunnon päänäkymä ilman selainta.
+#
+#   BENCH_DATABASE_URL=postgresql://localhost/diidelain_bench python benchmark.py --output tulos.json
+#   python benchmark.py --backend sqlite --sizes 100,10000
+#   python benchmark.py --compare edellinen.json --threshold 1.25
+#
+# Postgres-mittaus ajetaan omassa skeemassaan, joka poistetaan ja luodaan uudelleen
+# jokaiselle datakoolle; älä silti osoita sitä tuotantokantaan. SQLite-mittaus
+# käyttää väliaikaista tiedostoa.
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sqlite3
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+import psycopg2
+import psycopg2.extensions
+
+# --- ASETUKSET ---
+BENCH_BACKEND = os.getenv("BENCH_BACKEND", "postgres")
+BENCH_DATABASE_URL = os.getenv("BENCH_DATABASE_URL")
+BENCH_SQLITE_PATH = os.getenv("BENCH_SQLITE_PATH") or os.path.join(tempfile.gettempdir(), "diidelain_bench.db")
+BENCH_SCHEMA = os.getenv("BENCH_SCHEMA", "diidelain_bench")
+BENCH_SIZES = os.getenv("BENCH_SIZES", "100,10000,100000")
+BENCH_REPEAT = int(os.getenv("BENCH_REPEAT", "5"))
+BENCH_MASTERS = int(os.getenv("BENCH_MASTERS", "8"))
+BENCH_CATEGORIES = int(os.getenv("BENCH_CATEGORIES", "40"))
+BENCH_BULK = int(os.getenv("BENCH_BULK", "100"))
+BENCH_SEED = int(os.getenv("BENCH_SEED", "42"))
+
+app = None
+
+# --- APUFUNKTIOT ---
+def log(*args):
+    print(*args, file=sys.stderr, flush=True)
+
+def summarize(samples):
+    samples = sorted(samples)
+    ms = [s * 1000 for s in samples]
+    return {
+        "n": len(ms),
+        "min_ms": round(ms[0], 3),
+        "median_ms": round(statistics.median(ms), 3),
+        "mean_ms": round(statistics.fmean(ms), 3),
+        "p95_ms": round(ms[min(len(ms) - 1, int(len(ms) * 0.95))], 3),
+        "max_ms": round(ms[-1], 3),
+    }
+
+def measure(fn, repeat, setup=None, warmup=1):
+    # setup() palauttaa argumentit mittaukselle, sitä ei lasketa aikaan
+    samples = []
+    for i in range(warmup + repeat):
+        args = setup() if setup else ()
+        start = time.perf_counter()
+        fn(*args)
+        elapsed = time.perf_counter() - start
+        if i >= warmup:
+            samples.append(elapsed)
+    return summarize(samples)
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def load_app(args):
+    # app.py lukee asetukset tuontihetkellä, joten ympäristö asetetaan ensin
+    global app
+    os.environ["DB_BACKEND"] = args.backend
+    if args.backend == "sqlite":
+        os.environ["SQLITE_PATH"] = args.sqlite_path
+    else:
+        os.environ["DATABASE_URL"] = psycopg2.extensions.make_dsn(
+            args.database_url, options=f"-c search_path={BENCH_SCHEMA}")
+    os.environ.setdefault("DB_SSLMODE", "prefer")
+    os.environ["TASK_LIST_MODE"] = args.list_mode
+    # Ilman viivettä kirjoitusjono ei vääristä istuntomittauksia
+    os.environ.setdefault("WRITE_FLUSH_DELAY", "0")
+    # Selaimen tallenne odottaisi asiakkaan vastausta, jota mittausistunnossa ei tule
+    os.environ.setdefault("CLIENT_SNAPSHOT_ROWS", "0")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as module
+    app = module
+    return module
+
+# --- TESTIDATA ---
+def drop_database(args, recreate=False):
+    if args.backend == "sqlite":
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(args.sqlite_path + suffix):
+                os.remove(args.sqlite_path + suffix)
+        return
+    conn = psycopg2.connect(args.database_url, sslmode=os.environ["DB_SSLMODE"])
+    try:
+        with conn, conn.cursor() as cur:
+            cur.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE")
+            if recreate:
+                cur.execute(f"CREATE SCHEMA {BENCH_SCHEMA}")
+    finally:
+        conn.close()
+
+def reset_database(args):
+    # Vanha pooli suljetaan ennen kuin kanta poistetaan alta
+    if app.db._pool is not None:
+        app.db._pool.closeall()
+        app.db._pool = None
+    drop_database(args, recreate=True)
+    app.db.migrate()
+
+def server_version():
+    if app.db.dialect == "sqlite":
+        return sqlite3.sqlite_version
+    with app.db.connection() as conn:
+        return conn.server_version
+
+def seed(size, rng):
+    colors = list(app.AVAILABLE_COLORS.values())
+    icons = list(app.AVAILABLE_ICONS)
+    masters = [f"Pääkategoria {i + 1}" for i in range(BENCH_MASTERS)]
+    for name in masters:
+        app.db.add_master_category(name, rng.choice(colors), rng.choice(icons))
+    master_ids = {m[1]: m[0] for m in app.db.get_master_categories()}
+
+    # Noin puolet kategorioista kuuluu johonkin pääkategoriaan
+    for i in range(BENCH_CATEGORIES):
+        master = masters[i % len(masters)] if masters and i % 2 == 0 else None
+        app.db.add_category(f"Kategoria {i + 1}", rng.choice(colors), rng.choice(icons),
+                            master_ids.get(master))
+    names = [c[1] for c in app.db.get_categories()]
+
+    today = date.today()
+    out = io.StringIO()
+    for i in range(size):
+        # Kymmenesosalla tehtävistä ei ole päivämäärää
+        deadline = None if rng.random() < 0.1 else today + timedelta(days=rng.randint(-60, 365))
+        out.write(json.dumps({
+            "content": f"Tehtävä {i + 1}",
+            "category": rng.choice(names),
+            "deadline": deadline.strftime("%d.%m.%Y") if deadline else "",
+            "completed": rng.random() < 0.3,
+            "description": f"Kuvaus tehtävälle {i + 1}" if rng.random() < 0.5 else "",
+        }, ensure_ascii=False))
+        out.write("\n")
+    out.seek(0)
+    app.db.import_tasks(out, "ndjson")
+
+    with app.db.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("ANALYZE")
+
+# --- TIETOKANTAMITTAUKSET ---
+def bench_db(repeat, rng):
+    db = app.db
+    results = {}
+    snapshot = app.category_cache.get()
+    category_counts = {}
+    for t in db.get_tasks():
+        category_counts[t[2]] = category_counts.get(t[2], 0) + 1
+    largest = max(category_counts, key=category_counts.get)
+    category_id = snapshot.id_by_name[largest]
+    master_id = next((m[0] for m in snapshot.masters if snapshot.children_by_master.get(m[0])), None)
+    all_rows = db.get_tasks()
+    middle = all_rows[len(all_rows) // 2]
+
+    results["get_master_categories"] = measure(db.get_master_categories, repeat)
+    results["get_categories"] = measure(db.get_categories, repeat)
+    results["get_tasks_all"] = measure(db.get_tasks, repeat)
+    results["get_tasks_category"] = measure(lambda: db.get_tasks(category_id=category_id), repeat)
+    results["get_tasks_category_name"] = measure(lambda: db.get_tasks(largest), repeat)
+    if master_id is not None:
+        results["get_tasks_master"] = measure(lambda: db.get_tasks(master_id=master_id), repeat)
+    results["get_tasks_first_page"] = measure(lambda: db.get_tasks(limit=app.TASK_PAGE_SIZE), repeat)
+    results["get_change_token"] = measure(db.get_change_token, repeat)
+    results["get_task_counts"] = measure(db.get_task_counts, repeat)
+    results["get_overdue_tasks"] = measure(db.get_overdue_tasks, repeat)
+    results["get_due_tasks_week"] = measure(lambda: db.get_due_tasks(*app.due_range("Tällä viikolla")), repeat)
+    results["get_archived_tasks_first_page"] = measure(db.get_archived_tasks, repeat)
+    results["get_tasks_keyset_page"] = measure(
+        lambda: db.get_tasks(after=(middle[3], middle[0]), limit=app.TASK_PAGE_SIZE), repeat)
+
+    def bump_categories():
+        db._categories_changed()
+        return ()
+    results["category_cache_cold"] = measure(app.category_cache.get, repeat, setup=bump_categories)
+
+    deadline = date.today().strftime("%Y-%m-%d")
+    results["add_task"] = measure(lambda: db.add_task("Mittaus", largest, deadline, None), repeat)
+    added = [t[0] for t in db.get_tasks(category_id=category_id) if t[1] == "Mittaus"]
+    ids = iter(added)
+    results["update_task"] = measure(
+        lambda t_id: db.update_task(t_id, "Mittaus 2", largest, deadline, "kuvaus"), repeat,
+        setup=lambda: (added[0],))
+    results["toggle_task"] = measure(db.toggle_task, repeat, setup=lambda: (added[0], False))
+    results["delete_task"] = measure(db.delete_task, repeat, setup=lambda: (next(ids),))
+
+    bulk_ids = [t[0] for t in rng.sample(all_rows, min(BENCH_BULK, len(all_rows)))]
+    results["toggle_tasks"] = measure(lambda: db.toggle_tasks(bulk_ids, True), repeat)
+    results["move_tasks"] = measure(lambda: db.move_tasks(bulk_ids, largest), repeat)
+
+    inserts = [(f"Erä {i}", largest, deadline, None, False) for i in range(BENCH_BULK)]
+    batches = []
+    results["apply_task_writes_insert"] = measure(lambda: batches.append(db.apply_task_writes(inserts=inserts)), repeat)
+    results["apply_task_writes_mixed"] = measure(
+        lambda new_ids: db.apply_task_writes(
+            updates=[("Erä", largest, deadline, "x", t_id) for t_id in new_ids[: len(new_ids) // 2]],
+            toggles=[(True, t_id) for t_id in new_ids[len(new_ids) // 2:]]),
+        repeat, setup=lambda: (batches[0],))
+    results["delete_tasks"] = measure(db.delete_tasks, repeat, setup=lambda: (batches.pop(),))
+
+    results["export_tasks_csv"] = measure(lambda: db.export_tasks(io.StringIO(), "csv"), repeat)
+    results["export_tasks_ndjson"] = measure(lambda: db.export_tasks(io.StringIO(), "ndjson"), repeat)
+    return results
+
+# --- KORTTIMITTAUKSET ---
+def noop(*args):
+    pass
+
+def make_card(t):
+    return app.TaskCard(t, on_toggle=noop, on_edit=noop, on_delete=noop, on_tap=noop)
+
+def bench_cards(repeat, full_list=True):
+    # render_tasks-polun kontrollipuun rakentaminen ilman tietokantaa ja selainta.
+    # full_list=False mittaa vain sivutetun listan.
+    results = {}
+    rows = app.db.get_tasks()
+    snapshot = app.category_cache.get()
+
+    def fetch(after, limit):
+        return app.task_records.get_many(app.db.get_tasks(after=after, limit=limit), snapshot)
+    results["task_records_cold"] = measure(
+        lambda: [app.TaskRecord(row, snapshot.color_by_name.get(row[2], app.COLOR_PRIMARY)) for row in rows], repeat)
+    # Lämmin muunnos osuu välimuistiin, koska records pitää tietueet elossa
+    records = app.task_records.get_many(rows, snapshot)
+    results["task_records_warm"] = measure(lambda: app.task_records.get_many(rows, snapshot), repeat)
+    first_page = records[: app.TASK_PAGE_SIZE]
+    results["virtual_list_load_first_page"] = measure(
+        lambda task_list: task_list.load(first_page, fetch, key="Kaikki", limit=app.TASK_PAGE_SIZE),
+        repeat, setup=lambda: (app.VirtualTaskList(make_card),))
+    if not full_list:
+        return results
+
+    results["task_card_build"] = measure(lambda: [make_card(t) for t in records], repeat)
+    results["task_list_set_tasks_cold"] = measure(
+        lambda task_list: task_list.set_tasks(records), repeat,
+        setup=lambda: (app.TaskList(make_card),))
+
+    warm = app.TaskList(make_card)
+    warm.set_tasks(records)
+    results["task_list_set_tasks_warm"] = measure(lambda: warm.set_tasks(records), repeat)
+    changed = [t.replace(completed=not t.completed) for t in records]
+    flip = iter([changed, records] * (repeat + 1))
+    results["task_list_set_tasks_all_changed"] = measure(lambda: warm.set_tasks(next(flip)), repeat)
+    return results
+
+# --- ISTUNTOMITTAUKSET ---
+def headless_page():
+    # Flet-sivu, jonka yhteys käsittelee komennot paikallisesti ja laskee
+    # selaimelle lähtevät komennot
+    from flet.core.local_connection import LocalConnection
+    from flet.core.page import Page
+    from flet.core.protocol import PageCommandResponsePayload, PageCommandsBatchResponsePayload
+    from flet.core.pubsub.pubsub_hub import PubSubHub
+
+    class HeadlessConnection(LocalConnection):
+        def __init__(self):
+            super().__init__()
+            self.commands = 0
+            self.payload_bytes = 0
+
+        def _count(self, commands):
+            self.commands += len(commands)
+            self.payload_bytes += sum(len(json.dumps(c.attrs)) + len(json.dumps(c.values)) for c in commands)
+
+        def send_command(self, session_id, command):
+            result, _ = self._process_command(command)
+            self._count([command])
+            return PageCommandResponsePayload(result=result, error="")
+
+        def send_commands(self, session_id, commands):
+            results = []
+            for c in commands:
+                result, _ = self._process_command(c)
+                if c.name in ["add", "get"]:
+                    results.append(result)
+            self._count(commands)
+            return PageCommandsBatchResponsePayload(results=results, error="")
+
+    conn = HeadlessConnection()
+    executor = ThreadPoolExecutor()
+    # Flet-palvelin antaa yhteydelle pubsub-keskuksen, jolla on tapahtumasilmukka
+    conn.pubsubhub = PubSubHub(loop=asyncio.get_running_loop(), executor=executor)
+    page = Page(conn, "benchmark", loop=asyncio.get_running_loop(), executor=executor)
+    return conn, page
+
+async def close_page(page):
+    # Kuten Flet-palvelin istunnon päättyessä: close-tapahtuma ja sivun purku
+    from flet.core.event import Event
+    await page.on_event_async(Event("page", "close", ""))
+    page._close()
+
+def find_controls(control, cls, found=None):
+    found = [] if found is None else found
+    if isinstance(control, cls):
+        found.append(control)
+    for child in control._get_children():
+        find_controls(child, cls, found)
+    return found
+
+async def bench_session(repeat):
+    import flet as ft
+    results = {}
+
+    async def start():
+        conn, page = headless_page()
+        started = time.perf_counter()
+        await app.main(page)
+        return time.perf_counter() - started, conn, page
+
+    samples = []
+    page = None
+    for i in range(repeat + 1):
+        if page is not None:
+            await close_page(page)
+        elapsed, conn, page = await start()
+        if i:
+            samples.append(elapsed)
+    results["session_start"] = summarize(samples)
+    results["session_start"]["commands"] = conn.commands
+    results["session_start"]["payload_bytes"] = conn.payload_bytes
+
+    tabs = find_controls(page, ft.Tabs)[0]
+    snapshot = app.category_cache.get()
+
+    def tab_index(kind):
+        for i, tab in enumerate(tabs.tabs):
+            if kind == "all" and tab.text == "Kaikki":
+                return i
+            if kind == "master" and tab.text in snapshot.master_by_name:
+                return i
+            if kind == "category" and tab.text in snapshot.id_by_name:
+                return i
+        return None
+
+    async def switch(index):
+        tabs.selected_index = index
+        await tabs.on_change(type("Event", (), {"control": tabs})())
+
+    for kind in ("master", "category", "all"):
+        index = tab_index(kind)
+        if index is None:
+            continue
+        # Vuorotellaan toiselle välilehdelle; toistuvat vaihdot osuvat välilehtien välimuistiin
+        other = tab_index("category" if kind != "category" else "all")
+        samples = []
+        for i in range(repeat + 1):
+            await switch(other)
+            start = time.perf_counter()
+            await switch(index)
+            if i:
+                samples.append(time.perf_counter() - start)
+        results[f"tab_switch_{kind}"] = summarize(samples)
+
+    # Välilehden välimuisti on voimassa vain, kun mikään tehtävä ei ole muuttunut;
+    # tämä mittaa vaihdon tehtävämuutoksen jälkeen
+    index, other = tab_index("all"), tab_index("category")
+    if other is not None:
+        first = app.db.get_tasks(limit=1)
+        samples = []
+        for i in range(repeat + 1):
+            await switch(other)
+            app.db.toggle_task(first[0][0], first[0][4])
+            start = time.perf_counter()
+            await switch(index)
+            if i:
+                samples.append(time.perf_counter() - start)
+        results["tab_switch_after_write"] = summarize(samples)
+
+    # refresh_main_view ajetaan asetusikkunan sulkemisen kautta kuten käyttäjä tekisi
+    await switch(tab_index("all"))
+    settings_button = page.appbar.actions[-1]
+    await settings_button.on_click(None)
+    dialogs = [c for c in find_controls(page, ft.AlertDialog) if c.open]
+    close_button = dialogs[0].actions[-1]
+    samples = []
+    for i in range(repeat + 1):
+        app.db._categories_changed()
+        start = time.perf_counter()
+        await asyncio.wrap_future(close_button.on_click(None))
+        if i:
+            samples.append(time.perf_counter() - start)
+    results["refresh_main_view"] = summarize(samples)
+    await close_page(page)
+    return results
+
+# --- VERTAILU ---
+def compare(base, current, threshold):
+    # Tulostaa mediaanien suhteet; palauttaa hidastuneet mittaukset
+    regressions = []
+    for size, sections in current["results"].items():
+        base_sections = base.get("results", {}).get(size, {})
+        for section, metrics in sections.items():
+            for name, stats in metrics.items():
+                old = base_sections.get(section, {}).get(name)
+                if not old or not old.get("median_ms"):
+                    continue
+                ratio = stats["median_ms"] / old["median_ms"]
+                flag = ""
+                if threshold and ratio > threshold:
+                    flag = "  HIDASTUI"
+                    regressions.append(f"{size}/{section}/{name}")
+                log(f"{size:>8} {section:<8} {name:<34} {old['median_ms']:>10.2f} -> {stats['median_ms']:>10.2f} ms  x{ratio:.2f}{flag}")
+    return regressions
+
+# --- PÄÄOHJELMA ---
+def run(args):
+    load_app(args)
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "backend": args.backend,
+            "list_mode": args.list_mode,
+            "repeat": args.repeat,
+            "masters": BENCH_MASTERS,
+            "categories": BENCH_CATEGORIES,
+            "seed": BENCH_SEED,
+            "skipped": [],
+        },
+        "results": {},
+    }
+    try:
+        import flet
+        report["meta"]["flet"] = flet.version.version
+    except Exception:
+        report["meta"]["flet"] = None
+
+    for size in sizes:
+        rng = random.Random(BENCH_SEED)
+        log(f"Datakoko {size}: alustetaan kanta")
+        reset_database(args)
+        start = time.perf_counter()
+        seed(size, rng)
+        result = {"seed": {"import_tasks": summarize([time.perf_counter() - start])}}
+        report["meta"]["server_version"] = server_version()
+        log(f"Datakoko {size}: tietokanta")
+        result["db"] = bench_db(args.repeat, rng)
+        if not args.skip_ui:
+            # Column-tila rakentaa kortin jokaiselle tehtävälle; suurilla datoilla
+            # koko listan mittaukset voi rajata pois
+            full_list = not args.ui_max_rows or size <= args.ui_max_rows
+            if not full_list:
+                report["meta"]["skipped"].append(f"{size}/cards: koko listan kortit (--ui-max-rows {args.ui_max_rows})")
+            log(f"Datakoko {size}: kortit")
+            result["cards"] = bench_cards(args.repeat, full_list)
+            if full_list or args.list_mode == "virtual":
+                log(f"Datakoko {size}: istunto")
+                result["session"] = asyncio.run(bench_session(args.repeat))
+            else:
+                report["meta"]["skipped"].append(f"{size}/session: column-tila (--ui-max-rows {args.ui_max_rows})")
+        report["results"][str(size)] = result
+
+    app.write_queue.flush()
+    if args.drop:
+        app.db.pool.closeall()
+        drop_database(args)
+    return report
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Retro Taskmaster -suorituskykymittaukset")
+    parser.add_argument("--backend", choices=("postgres", "sqlite"), default=BENCH_BACKEND)
+    parser.add_argument("--database-url", default=BENCH_DATABASE_URL, help="oletus BENCH_DATABASE_URL")
+    parser.add_argument("--sqlite-path", default=BENCH_SQLITE_PATH, help="oletus BENCH_SQLITE_PATH")
+    parser.add_argument("--sizes", default=BENCH_SIZES, help="tehtävämäärät pilkuin eroteltuna")
+    parser.add_argument("--repeat", type=int, default=BENCH_REPEAT)
+    parser.add_argument("--list-mode", choices=("column", "virtual"), default=os.getenv("TASK_LIST_MODE", "column"))
+    parser.add_argument("--skip-ui", action="store_true", help="vain tietokantamittaukset")
+    parser.add_argument("--ui-max-rows", type=int, default=20000,
+                        help="ohita koko listan korttimittaukset ja column-tilan istunto tätä suuremmilla datoilla (0 = ei rajaa)")
+    parser.add_argument("--drop", action="store_true", help="poista mittauskanta lopuksi")
+    parser.add_argument("--output", default="-", help="JSON-tulos, oletuksena stdout")
+    parser.add_argument("--compare", help="aiempi JSON-tulos vertailua varten")
+    parser.add_argument("--threshold", type=float, default=None,
+                        help="palauta virhekoodi, jos mediaani hidastuu tätä kerrointa enemmän")
+    args = parser.parse_args(argv)
+    if args.backend == "postgres" and not args.database_url:
+        parser.error("BENCH_DATABASE_URL puuttuu")
+
+    # Migraatioiden tulosteet eivät saa sekoittua stdoutiin kirjoitettavaan JSONiin
+    with contextlib.redirect_stdout(sys.stderr):
+        report = run(args)
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output == "-":
+        print(text)
+    else:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare(json.load(f), report, args.threshold)
+        if regressions:
+            log(f"Hidastuneita mittauksia: {len(regressions)}")
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,144 @@
+import os
+import sys
+import tempfile
+
+# app.py lukee asetukset tuontihetkellä, joten testikanta asetetaan ensin
+os.environ["DB_BACKEND"] = "sqlite"
+os.environ["SQLITE_PATH"] = os.path.join(tempfile.mkdtemp(), "test.db")
+os.environ["METRICS_PORT"] = "0"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+
+app.db.migrate()
+
+def add_task(content, deadline="2099-01-01"):
+    app.db.add_task(content, "Työ", deadline, None)
+    return next(t[0] for t in app.db.get_tasks() if t[1] == content)
+
+# --- KIRJOITUSJONO ---
+def test_failed_write_reports_only_its_own_row():
+    bad_id, good_id = add_task("huono"), add_task("hyvä")
+    queue = app.WriteBehindQueue(app.db, delay=60)
+    errors, done = [], []
+    queue.update(bad_id, "huono", "Työ", "2099-02-30", None,
+                 on_error=lambda e: errors.append(bad_id), on_done=done.append)
+    queue.toggle(good_id, True, on_error=lambda e: errors.append(good_id), on_done=done.append)
+    queue.flush()
+    assert errors == [bad_id]
+    assert done == [good_id]
+    tasks = {t[0]: t for t in app.db.get_tasks()}
+    assert tasks[good_id][4] is True
+    assert str(tasks[bad_id][3]) == "2099-01-01"
+
+def test_failing_error_handler_does_not_skip_others():
+    first_id, second_id = add_task("eka"), add_task("toka")
+    queue = app.WriteBehindQueue(app.db, delay=60)
+    reverted = []
+    def broken(e):
+        raise RuntimeError("sivu suljettu")
+    queue.update(first_id, "eka", "Työ", "2099-02-30", None, on_error=broken)
+    queue.update(second_id, "toka", "Työ", "2099-02-31", None, on_error=lambda e: reverted.append(second_id))
+    queue.flush()
+    assert reverted == [second_id]
+
+# --- SELAIMEN TALLENNE ---
+def headless_page(storage):
+    # Flet-sivu ilman selainta; client_storage vastaa storage-sanakirjasta
+    import asyncio
+    import json
+    from concurrent.futures import ThreadPoolExecutor
+    from flet.core.event import Event
+    from flet.core.local_connection import LocalConnection
+    from flet.core.page import Page
+    from flet.core.protocol import PageCommandResponsePayload, PageCommandsBatchResponsePayload
+    from flet.core.pubsub.pubsub_hub import PubSubHub
+
+    loop = asyncio.get_running_loop()
+
+    class StorageConnection(LocalConnection):
+        def _answer(self, command):
+            if command.name != "invokeMethod" or command.values[1] != "clientStorage:get":
+                return
+            # Selain tallentaa arvon JSON-tekstinä ja palauttaa sen vielä JSON-koodattuna
+            value = json.dumps(json.dumps(storage[command.attrs["key"]])) if command.attrs["key"] in storage else "null"
+            result = json.dumps({"method_id": command.values[0], "result": value, "error": ""})
+            loop.call_soon_threadsafe(lambda: asyncio.ensure_future(page.on_event_async(Event("page", "invoke_method_result", result))))
+
+        def send_command(self, session_id, command):
+            result, _ = self._process_command(command)
+            self._answer(command)
+            return PageCommandResponsePayload(result=result, error="")
+
+        def send_commands(self, session_id, commands):
+            results = []
+            for c in commands:
+                result, _ = self._process_command(c)
+                if c.name in ["add", "get"]:
+                    results.append(result)
+                self._answer(c)
+            return PageCommandsBatchResponsePayload(results=results, error="")
+
+    conn = StorageConnection()
+    executor = ThreadPoolExecutor()
+    conn.pubsubhub = PubSubHub(loop=loop, executor=executor)
+    page = Page(conn, "test", loop=loop, executor=executor)
+    return page
+
+def find_controls(control, cls, found=None):
+    found = [] if found is None else found
+    if isinstance(control, cls):
+        found.append(control)
+    for child in control._get_children():
+        find_controls(child, cls, found)
+    return found
+
+def test_snapshot_stays_when_database_load_fails(monkeypatch):
+    import asyncio
+    import time
+    from datetime import datetime
+    import flet as ft
+
+    storage = {app.CLIENT_SNAPSHOT_KEY: {
+        "v": app.CLIENT_SNAPSHOT_VERSION,
+        "saved": datetime(2099, 1, 1, 12, 30).isoformat(timespec="seconds"),
+        "tab": "Kaikki",
+        "categories": [[1, "Työ", "#F96635", "Työ", None]],
+        "masters": [],
+        "counts": [["Työ", 1, 0]],
+        "tasks": [[1, "tallennettu", "Työ", "2099-01-01", False, None]]
+    }}
+
+    def unreachable():
+        # Kanta vastaa vasta tallenteen piirron jälkeen, ja silloinkin virheellä
+        time.sleep(0.3)
+        raise app.psycopg2.OperationalError("ei yhteyttä")
+
+    monkeypatch.setattr(app.db.pool, "getconn", unreachable)
+    monkeypatch.setattr(app, "DB_READ_RETRIES", 0)
+
+    async def run():
+        page = headless_page(storage)
+        await app.main(page)
+        return page
+
+    try:
+        page = asyncio.run(run())
+    finally:
+        app.db.breaker.success()
+    texts = [c.value for c in find_controls(page, ft.Text)]
+    assert "tallennettu" in texts
+    assert any("klo 12.30 haetut tiedot" in str(t) for t in texts)
+    assert not any(str(t).startswith("Virhe:") for t in texts)
+
+# --- TYÖPROSESSIT ---
+def test_small_pool_budget_reduces_workers():
+    import pytest
+    workers = app.worker_count(4, 5)
+    assert workers == 2
+    # Jokaisella prosessilla pooli ja LISTEN-yhteys, lisäksi pääprosessin arkistointi
+    assert workers * (app.worker_pool_size(workers, 5) + 1) + 1 <= 5
+    with pytest.raises(ValueError):
+        app.worker_count(4, 2)
+    with pytest.raises(ValueError):
+        app.worker_pool_size(4, 5)